@@ -1,9 +1,29 @@
+import codecs
+import dataclasses
+import hashlib
 import os
-from flask import Flask, jsonify, request
+import random
+import re
+import sqlite3
+import tempfile
+from flask import Flask, Response, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import boto3
-from botocore.exceptions import ClientError
+import json
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+import botocore.client
+import botocore.session
 import logging
+import threading
+import time
+import uuid
+import weakref
+from datetime import datetime
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import orjson
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,7 +34,7 @@ app = Flask(__name__)
 CORS(app)
 
 # --- AWS Configuration ---
-# Boto3 will automatically look for credentials in the following order:
+# botocore will automatically look for credentials in the following order:
 # 1. Environment variables (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN)
 # 2. Shared credential file (~/.aws/credentials)
 # 3. AWS config file (~/.aws/config)
@@ -26,14 +46,724 @@ CORS(app)
 # export AWS_SECRET_ACCESS_KEY="YOUR_SECRET_KEY"
 # export AWS_DEFAULT_REGION="us-east-1" # Or any preferred default region
 
+# --- Compact Records and JSON Serialization ---
+# Large accounts hold tens of thousands of resources in memory per scan, so each
+# resource is a Record: a slotted dataclass that costs about 40% less than a dict
+# but is read like the dict it replaces. orjson encodes dataclasses natively, without
+# a Python callback per record, and writes their fields in declaration order whatever
+# OPT_SORT_KEYS says, so records declare their fields sorted, the order jsonify()
+# writes keys in. JSON goes through dumps_json(), which uses orjson and falls back to
+# the standard encoder wherever the two would not produce identical output, which
+# inventory payloads never reach. orjson reads slots through attribute lookups, so a
+# fresh scan's response encodes only about 20% faster than the same dicts did with
+# Flask's encoder; snapshots served from the store are plain dicts and encode about
+# four times as fast (see benchmarks/serialization.py).
+
+class Record:
+    """
+    Base class of compact resource records (see make_record_type()). Supports record['id'],
+    record.get('name'), 'id' in record, dict(record) and {**record}. Every field is always
+    set: orjson cannot encode a slot that was never assigned, so a service with an
+    optional field uses a second record type (see S3BucketMetricsRecord).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a record from a dict with exactly the record's keys."""
+        return cls(**data)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def items(self):
+        return self.to_dict().items()
+
+    def to_dict(self):
+        """Returns the record as a plain dict, in field order."""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+def make_record_type(name, fields):
+    """
+    Returns a Record dataclass with one slot per field name (each a Python identifier).
+    Fields are declared in sorted order; its constructor takes the values in that order.
+    """
+    fields = tuple(fields)
+    invalid = [field for field in fields if not field.isidentifier()]
+    if invalid:
+        raise ValueError(f"Record fields must be identifiers: {invalid}")
+    return dataclasses.make_dataclass(name, sorted(fields), bases=(Record,), slots=True, eq=False, repr=False)
+
+def _json_default(value):
+    # orjson encodes records itself; the standard encoder needs them as dicts.
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+# Dates and subclasses of built-in types go to default, as they do with json.
+_ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+
+def _escape_non_ascii(error):
+    """Codec error handler that escapes non-ASCII text the way json.dumps(ensure_ascii=True) does."""
+    escaped = []
+    for character in error.object[error.start:error.end]:
+        code = ord(character)
+        if code < 0x10000:
+            escaped.append(f'\\u{code:04x}')
+        else:
+            code -= 0x10000
+            escaped.append(f'\\u{0xd800 | (code >> 10):04x}\\u{0xdc00 | (code & 0x3ff):04x}')
+    return ''.join(escaped), error.end
+
+codecs.register_error('json_escape', _escape_non_ascii)
+
+def dumps_json(value, sort_keys=False, default=_json_default, indent=None):
+    """
+    Returns value as compact JSON text, identical to
+    json.dumps(value, separators=(',', ':'), sort_keys=sort_keys, default=default),
+    or as json.dumps(..., indent=2) formats it when indent is 2. orjson writes non-ASCII text unescaped, so it is escaped afterwards; values orjson rejects, such as
+    non-string keys or very large ints, take the standard encoder. Inventory payloads
+    carry no floats outside the range where the two encoders format them the same.
+    Dataclasses other than Records must declare their fields sorted to match with
+    sort_keys, as orjson writes them in field order.
+    """
+    if indent in (None, 2):
+        option = _ORJSON_OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0) | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            payload = orjson.dumps(value, default=default, option=option)
+        except TypeError:
+            payload = None
+        if payload is not None:
+            if not payload.isascii():
+                payload = payload.decode('utf-8').encode('ascii', 'json_escape')
+            # DEL is ASCII, but json escapes it too.
+            return payload.replace(b'\x7f', b'\\u007f').decode('ascii')
+    if indent is not None:
+        return json.dumps(value, indent=indent, sort_keys=sort_keys, default=default)
+    return json.dumps(value, separators=(',', ':'), sort_keys=sort_keys, default=default)
+
+class InventoryJSONProvider(DefaultJSONProvider):
+    """Flask's default JSON provider, extended to Records and the dumps_json() fast path."""
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, Record):
+            return value.to_dict()
+        return DefaultJSONProvider.default(value)
+
+    def dumps(self, obj, **kwargs):
+        # jsonify() asks for compact separators, or for an indent of 2 in debug mode.
+        if kwargs in ({'separators': (',', ':')}, {'indent': 2}) and self.ensure_ascii:
+            return dumps_json(obj, sort_keys=self.sort_keys, default=self.default, indent=kwargs.get('indent'))
+        return super().dumps(obj, **kwargs)
+
+app.json = InventoryJSONProvider(app)
+
+# --- Shared botocore Session and Client Pool ---
+# Creating a client resolves endpoints, loads the service model and opens a fresh HTTPS
+# connection. Clients are thread-safe once built, so we build each (service, region)
+# client once on a single shared Session and reuse it across requests and threads.
+# Clients are built on botocore directly: boto3's Session only wraps botocore's for
+# clients, and importing boto3 (with s3transfer and the resource layer) adds to every
+# cold start.
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50')),
+    tcp_keepalive=True,
+    # Retries are handled by call_aws() so throttles feed the adaptive rate limiter.
+    retries={'mode': 'standard', 'total_max_attempts': 1},
+)
+
+# For every client, botocore also builds a fresh ServiceModel and a client class with one
+# method per API operation (over 700 for EC2), which costs more than the rest of a client
+# once the service's JSON model is loaded. Neither depends on the region, so both are
+# built once per service and Session (keyed by the Session's data loader) and shared by
+# the clients of every region, which halves the cost of building a service's client in
+# each further region.
+_shared_client_parts = weakref.WeakKeyDictionary()
+
+def _share_per_loader(build):
+    """Wraps a ClientCreator method so its result is built once per data loader and arguments."""
+    def shared(creator, *args, **kwargs):
+        parts = _shared_client_parts.setdefault(creator._loader, {})
+        key = (build.__name__, args, tuple(sorted(kwargs.items())))
+        part = parts.get(key)
+        if part is None:
+            # A race builds a part twice at worst, and both copies are equivalent.
+            part = parts.setdefault(key, build(creator, *args, **kwargs))
+        return part
+    return shared
+
+for _method in ('_load_service_model', '_create_client_class'):
+    # Internal botocore methods; without them every client is built from scratch as before.
+    if hasattr(botocore.client.ClientCreator, _method):
+        setattr(botocore.client.ClientCreator, _method,
+                _share_per_loader(getattr(botocore.client.ClientCreator, _method)))
+
+# Environment variables that change which credentials a new Session would resolve.
+_CREDENTIAL_ENV_VARS = ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE')
+
+class ClientPool:
+    """
+    Cache of botocore clients keyed by (service, region) for one identity. The default
+    pool uses the backend's own credentials; session_factory builds the Session for
+    another identity, such as an assumed role in a member account.
+    """
+
+    def __init__(self, config=CLIENT_CONFIG, session_factory=None, name='default'):
+        self._config = config
+        self._session_factory = session_factory
+        self.name = name
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._session = None
+        self._credential_key = None
+
+    def _environment_key(self):
+        # Only the default Session resolves its credentials from the environment.
+        if self._session_factory is not None:
+            return None
+        return tuple(os.environ.get(name) for name in _CREDENTIAL_ENV_VARS)
+
+    def _current_credential_key(self):
+        env_key = self._environment_key()
+        if self._session is None:
+            return env_key, None
+        credentials = self._session.get_credentials()
+        if credentials is None:
+            return env_key, None
+        if isinstance(credentials, RefreshableCredentials):
+            # Refreshable credentials rotate their keys in place for the same identity.
+            return env_key, id(credentials)
+        frozen = credentials.get_frozen_credentials()
+        return env_key, (frozen.access_key, frozen.token)
+
+    def _ensure_session(self):
+        """Creates the Session, dropping every cached client if the credentials changed."""
+        env_key = self._environment_key()
+        if self._session is not None and self._credential_key is not None and self._credential_key[0] != env_key:
+            logging.info("AWS credential environment changed. Rebuilding botocore session and client pool.")
+            self._session = None
+        if self._session is None:
+            self._session = self._session_factory() if self._session_factory else botocore.session.Session()
+            self._clients.clear()
+            self._credential_key = self._current_credential_key()
+            return
+        credential_key = self._current_credential_key()
+        if credential_key != self._credential_key:
+            logging.info("AWS credentials changed. Dropping pooled clients.")
+            self._clients.clear()
+            self._credential_key = credential_key
+
+    def get_client(self, service_name, region_name):
+        """Returns the pooled client for (service_name, region_name), creating it on first use."""
+        with self._lock:
+            # Session.create_client() is not thread-safe, so creation happens under the lock.
+            self._ensure_session()
+            key = (service_name, region_name)
+            client = self._clients.get(key)
+            if client is None:
+                client = self._session.create_client(service_name, region_name=region_name, config=self._config)
+                self._clients[key] = client
+            return client
+
+    @property
+    def session(self):
+        """The botocore Session used to build pooled clients."""
+        with self._lock:
+            self._ensure_session()
+            return self._session
+
+    def clear(self):
+        """Drops the session and every pooled client."""
+        with self._lock:
+            self._clients.clear()
+            self._session = None
+            self._credential_key = None
+
+client_pool = ClientPool()
+
+# Per-thread state of the discovery unit running on a thread: the client pool of the
+# account being scanned and the reasons the unit is incomplete.
+_unit_state = threading.local()
+
+def current_client_pool():
+    """Returns the client pool of the account scanned on this thread, or the default pool."""
+    return getattr(_unit_state, 'client_pool', None) or client_pool
+
+def get_client(service_name, region_name):
+    """Returns a pooled client for the account scanned on this thread."""
+    return current_client_pool().get_client(service_name, region_name)
+
+def bind_unit_context(fn, pool=None):
+    """
+    Wraps fn so that it runs against pool's account on any thread, recording into the
+    calling thread's request timings. pool defaults to the account scanned on the
+    calling thread.
+    """
+    pool = pool or getattr(_unit_state, 'client_pool', None)
+    timings = getattr(_unit_state, 'timings', None)
+
+    def run(*args, **kwargs):
+        previous = (getattr(_unit_state, 'client_pool', None), getattr(_unit_state, 'timings', None))
+        _unit_state.client_pool = pool
+        _unit_state.timings = timings
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _unit_state.client_pool, _unit_state.timings = previous
+    return run
+
+# --- Metrics ---
+# Every AWS call made through call_aws() is measured: latency, retries, throttles and
+# errors by service, region and operation, plus pages fetched and records found. The
+# counters and histograms live in this process and are served in the Prometheus text
+# format on /metrics. Accounts are deliberately not a label, to bound cardinality.
+METRIC_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    """Formats (name, value) pairs as a Prometheus label set."""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels) + '}'
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=METRIC_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._metadata = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, metric_type, help_text):
+        self._metadata[name] = (metric_type, help_text)
+
+    def inc(self, name, labels=(), amount=1):
+        """Adds amount to the counter name{labels}; labels is a tuple of (name, value) pairs."""
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Records value in the histogram name{labels}."""
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then the sum and the total count.
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format (0.0.4)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        lines = []
+        for name, (metric_type, help_text) in sorted(self._metadata.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", repr(bound)),))} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {values[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+metrics = MetricsRegistry()
+metrics.describe('aws_api_call_duration_seconds', 'histogram',
+                 'Duration of AWS API calls including retries and backoff.')
+metrics.describe('aws_api_calls_total', 'counter', 'AWS API calls made, counting each call once however often it was retried.')
+metrics.describe('aws_api_retries_total', 'counter', 'Retried AWS API attempts.')
+metrics.describe('aws_api_throttles_total', 'counter', 'AWS API attempts rejected by throttling.')
+metrics.describe('aws_api_errors_total', 'counter', 'AWS API calls that failed after their last attempt, by error code.')
+metrics.describe('aws_api_pages_total', 'counter', 'Pages fetched from paginated AWS API operations.')
+metrics.describe('discovery_unit_duration_seconds', 'histogram', 'Duration of (region, service) discovery units.')
+metrics.describe('discovery_records_total', 'counter', 'Resource records returned by discovery units.')
+metrics.describe('discovery_incomplete_units_total', 'counter', 'Discovery units that finished with missing data.')
+
+class RequestTimings:
+    """Per-request breakdown of AWS call time by (service, operation), from call_aws()."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def record(self, service, operation, seconds, retries, throttles, failed):
+        with self._lock:
+            entry = self._calls.setdefault((service, operation), [0, 0.0, 0, 0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += retries
+            entry[3] += throttles
+            entry[4] += 1 if failed else 0
+
+    def summary(self):
+        """Returns one dict per (service, operation), slowest first. Call time overlaps across threads."""
+        with self._lock:
+            calls = dict(self._calls)
+        return [{
+            'service': service, 'operation': operation, 'calls': count, 'seconds': round(seconds, 3),
+            'retries': retries, 'throttles': throttles, 'errors': errors,
+        } for (service, operation), (count, seconds, retries, throttles, errors)
+            in sorted(calls.items(), key=lambda item: -item[1][1])]
+
+    def server_timing(self):
+        """Returns a Server-Timing header value: the wall time, then summed call time per operation."""
+        entries = [f'total;dur={(time.monotonic() - self.started) * 1000:.1f}']
+        for entry in self.summary():
+            entries.append(f"{entry['service']}.{entry['operation']};dur={entry['seconds'] * 1000:.1f};"
+                           f"desc=\"{entry['calls']} calls, {entry['retries']} retries, {entry['throttles']} throttles\"")
+        return ', '.join(entries)
+
+# --- Rate Limiting and Retries ---
+# Every discovery call goes through call_aws(), which takes a token from a
+# per-(account, service, region) token bucket and retries throttled or transient failures with
+# jittered exponential backoff. Throttles halve the bucket's refill rate and successes
+# slowly restore it (AIMD), so parallel scans settle just below each API's limit. One
+# burst is usually reported by every call in flight, so the rate is halved at most once
+# per burst: only calls admitted since the last decrease can lower it again.
+# Rates are calls per second and can be tuned, e.g. export RATE_LIMIT_EC2=20
+DEFAULT_RATE_LIMITS = {'ec2': 20.0, 'lambda': 10.0, 'rds': 10.0, 's3': 50.0, 'cloudwatch': 10.0}
+DEFAULT_RATE_LIMIT = float(os.environ.get('RATE_LIMIT_DEFAULT', '10'))
+DISCOVERY_MAX_ATTEMPTS = int(os.environ.get('DISCOVERY_MAX_ATTEMPTS', '6'))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get('RETRY_BASE_DELAY_SECONDS', '0.5'))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get('RETRY_MAX_DELAY_SECONDS', '20'))
+
+THROTTLE_ERROR_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+    'RequestThrottled', 'RequestThrottledException', 'TooManyRequestsException',
+    'SlowDown', 'ProvisionedThroughputExceededException', 'BandwidthLimitExceeded',
+])
+TRANSIENT_ERROR_CODES = frozenset([
+    'InternalError', 'InternalFailure', 'ServiceUnavailable', 'ServiceUnavailableException',
+    'RequestTimeout', 'RequestTimeoutException', 'Unavailable',
+])
+TRANSIENT_EXCEPTIONS = (ConnectionClosedError, EndpointConnectionError, ReadTimeoutError)
+
+# Request and response token names for the paginated operations used by discovery.
+PAGINATION_TOKENS = {
+    'describe_instances': ('NextToken', 'NextToken'),
+    'describe_vpcs': ('NextToken', 'NextToken'),
+    'describe_db_instances': ('Marker', 'Marker'),
+    'list_functions': ('Marker', 'NextMarker'),
+    'get_resources': ('PaginationToken', 'PaginationToken'),
+    'list_buckets': ('ContinuationToken', 'ContinuationToken'),
+    'get_metric_data': ('NextToken', 'NextToken'),
+    'describe_load_balancers': ('Marker', 'NextMarker'),
+    'list_tables': ('ExclusiveStartTableName', 'LastEvaluatedTableName'),
+    # ECS and EKS both name their cluster listing list_clusters.
+    'list_clusters': ('nextToken', 'nextToken'),
+}
+
+class AdaptiveRateLimiter:
+    """Token bucket whose refill rate backs off on throttles and recovers on success."""
+
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        # Incremented on every decrease; identifies the rate a call was admitted under.
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Blocks until a call may be made. Returns the rate epoch to pass to on_throttle()."""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return self._epoch
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def on_throttle(self, epoch=None):
+        """
+        Halves the rate, unless it was already lowered after the throttled call was
+        admitted (epoch is older than the current one): that throttle is part of the
+        burst the earlier decrease responded to.
+        """
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._epoch += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Drain the burst so the other threads slow down immediately.
+            self._tokens = min(self._tokens, 0)
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(service_name, region_name, account='default'):
+    """
+    Returns the shared rate limiter for (service_name, region_name) in account.
+    API limits apply per account, so every account gets its own buckets.
+    """
+    key = (account, service_name, region_name)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            rate = float(os.environ.get(f'RATE_LIMIT_{service_name.upper()}',
+                                        DEFAULT_RATE_LIMITS.get(service_name, DEFAULT_RATE_LIMIT)))
+            limiter = _rate_limiters[key] = AdaptiveRateLimiter(rate)
+        return limiter
+
+def _is_throttle(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLE_ERROR_CODES
+
+def _is_retryable(error):
+    if isinstance(error, TRANSIENT_EXCEPTIONS) or _is_throttle(error):
+        return True
+    if isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return error.response['Error']['Code'] in TRANSIENT_ERROR_CODES or status >= 500
+    return False
+
+def call_aws(client, operation_name, **params):
+    """
+    Calls client.<operation_name>(**params) under the (account, service, region) rate
+    limiter, retrying throttles and transient errors. Non-retryable errors are raised at once.
+    """
+    service_name = client.meta.service_model.service_name
+    region_name = client.meta.region_name
+    limiter = get_rate_limiter(service_name, region_name, current_client_pool().name)
+    method = getattr(client, operation_name)
+    attempt = 0
+    throttles = 0
+    error_code = None
+    started = time.monotonic()
+    try:
+        while True:
+            attempt += 1
+            epoch = limiter.acquire()
+            try:
+                response = method(**params)
+            except Exception as e:
+                if _is_throttle(e):
+                    throttles += 1
+                    limiter.on_throttle(epoch)
+                if not _is_retryable(e) or attempt >= DISCOVERY_MAX_ATTEMPTS:
+                    error_code = e.response['Error']['Code'] if isinstance(e, ClientError) else type(e).__name__
+                    raise
+                delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+                logging.info(f"Retrying {operation_name} in {region_name} after {e} (attempt {attempt}, waiting {delay:.2f}s).")
+                time.sleep(delay)
+                continue
+            limiter.on_success()
+            return response
+    finally:
+        _record_call(service_name, region_name, operation_name, time.monotonic() - started,
+                     attempt - 1, throttles, error_code)
+
+def _record_call(service_name, region_name, operation_name, seconds, retries, throttles, error_code):
+    labels = (('service', service_name), ('region', region_name), ('operation', operation_name))
+    metrics.observe('aws_api_call_duration_seconds', labels, seconds)
+    metrics.inc('aws_api_calls_total', labels)
+    if retries:
+        metrics.inc('aws_api_retries_total', labels, retries)
+    if throttles:
+        metrics.inc('aws_api_throttles_total', labels, throttles)
+    if error_code is not None:
+        metrics.inc('aws_api_errors_total', labels + (('code', error_code),))
+    timings = getattr(_unit_state, 'timings', None)
+    if timings is not None:
+        timings.record(service_name, operation_name, seconds, retries, throttles, error_code is not None)
+
+def paginate_aws(client, operation_name, **params):
+    """
+    Yields every page of a paginated operation. Each page is fetched with call_aws(),
+    so a throttled page is retried from its own token instead of restarting the scan.
+    """
+    input_token, output_token = PAGINATION_TOKENS[operation_name]
+    labels = (('service', client.meta.service_model.service_name), ('region', client.meta.region_name),
+              ('operation', operation_name))
+    while True:
+        page = call_aws(client, operation_name, **params)
+        metrics.inc('aws_api_pages_total', labels)
+        yield page
+        next_token = page.get(output_token)
+        if not next_token:
+            return
+        params[input_token] = next_token
+
+# Slices that finish with missing data (a failed call that ran out of retries, or a
+# denied permission) are flagged so callers know the inventory is incomplete.
+def mark_incomplete(reason):
+    """
+    Flags the (region, service) unit running on this thread as incomplete. reason is
+    the AWS error code, prefixed with what failed when that is narrower than the unit
+    ('my-bucket: AccessDenied'), or the message of an unexpected error.
+    """
+    reasons = getattr(_unit_state, 'incomplete', None)
+    if reasons is not None:
+        reasons.append(reason)
+
+# --- Region Catalog ---
+# The region list almost never changes, so describe_regions is cached for
+# REGION_CACHE_TTL_SECONDS. Regions that are not opted in are skipped, as are
+# (service, region) pairs that botocore's endpoint data says do not exist.
+REGION_CACHE_TTL_SECONDS = int(os.environ.get('REGION_CACHE_TTL_SECONDS', '3600'))
+
+# OptInStatus values for regions that can be queried.
+ENABLED_OPT_IN_STATUSES = ('opt-in-not-required', 'opted-in')
+
+class RegionCatalog:
+    """
+    TTL cache of account regions, their opt-in status and per-service availability.
+    Regions are listed with pool's credentials, since opt-in status is per account.
+    """
+
+    def __init__(self, ttl_seconds=REGION_CACHE_TTL_SECONDS, pool=None):
+        self.ttl_seconds = ttl_seconds
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._opt_in_status = {}
+        self._fetched_at = None
+        self._service_regions = {}
+
+    def _is_fresh(self):
+        return self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl_seconds
+
+    def refresh(self, ec2_client=None):
+        """
+        Fetches every region with its opt-in status from EC2. An ec2_client passed in
+        is called once, without call_aws() retries.
+        """
+        if ec2_client is None:
+            # Use a default region to list all regions. us-east-1 is generally a good choice.
+            ec2_client = (self._pool or client_pool).get_client('ec2', 'us-east-1')
+            response = call_aws(ec2_client, 'describe_regions', AllRegions=True)
+        else:
+            response = ec2_client.describe_regions(AllRegions=True)
+        opt_in_status = {region['RegionName']: region.get('OptInStatus', 'opt-in-not-required')
+                         for region in response['Regions']}
+        with self._lock:
+            self._opt_in_status = opt_in_status
+            self._fetched_at = time.monotonic()
+        skipped = sorted(name for name, status in opt_in_status.items() if status not in ENABLED_OPT_IN_STATUSES)
+        if skipped:
+            logging.info(f"Skipping regions that are not opted in: {skipped}")
+
+    def get_regions(self):
+        """Returns the enabled regions, refreshing the cache when it has expired."""
+        if not self._is_fresh():
+            try:
+                self.refresh()
+            except Exception:
+                if not self._opt_in_status:
+                    raise
+                # Serve the stale list rather than failing the whole request.
+                logging.warning("Could not refresh AWS regions. Using the cached region list.", exc_info=True)
+        return [name for name, status in self._opt_in_status.items() if status in ENABLED_OPT_IN_STATUSES]
+
+    def opt_in_status(self, region_name):
+        """Returns the cached OptInStatus for region_name, or None if it is unknown."""
+        return self._opt_in_status.get(region_name)
+
+    def is_service_available(self, service_name, region_name):
+        """
+        Returns False only when botocore's endpoint data knows about region_name
+        but not about service_name in it. Regions newer than the installed botocore
+        are assumed to support every service.
+        """
+        session = client_pool.session
+        try:
+            partition = session.get_partition_for_region(region_name)
+        except Exception:
+            partition = 'aws'
+        # EC2 exists in every region, so its endpoint list stands in for "regions botocore knows".
+        if region_name not in self._endpoint_regions(session, 'ec2', partition):
+            return True
+        return region_name in self._endpoint_regions(session, service_name, partition)
+
+    def _endpoint_regions(self, session, service_name, partition):
+        key = (service_name, partition)
+        with self._lock:
+            if key not in self._service_regions:
+                self._service_regions[key] = frozenset(session.get_available_regions(service_name, partition))
+            return self._service_regions[key]
+
+    def clear(self):
+        """Forgets the cached region list."""
+        with self._lock:
+            self._opt_in_status = {}
+            self._fetched_at = None
+
+region_catalog = RegionCatalog()
+
 # --- Helper function to get all AWS regions ---
 def get_aws_regions():
-    """Fetches all available AWS regions."""
+    """Fetches all enabled AWS regions, served from the region catalog cache."""
     try:
-        # Use a default region to list all regions. us-east-1 is generally a good choice.
-        ec2_client = boto3.client('ec2', region_name='us-east-1')
-        response = ec2_client.describe_regions()
-        regions = [region['RegionName'] for region in response['Regions']]
+        regions = region_catalog.get_regions()
         logging.info(f"Discovered AWS regions: {regions}")
         return regions
     except ClientError as e:
@@ -43,230 +773,2335 @@ def get_aws_regions():
         logging.error(f"An unexpected error occurred while fetching regions: {e}")
         return []
 
+# --- Multi-Account Credentials ---
+# Member accounts of an organization are scanned by assuming a role in each of them
+# through STS. Every (account, role) gets its own client pool, region catalog and rate
+# limiters, cached across requests. The assumed-role credentials refresh themselves
+# before they expire (botocore renews them 15 minutes early), so long scans never run
+# on expired keys and repeated scans do not call STS again.
+ASSUME_ROLE_SESSION_NAME = os.environ.get('ASSUME_ROLE_SESSION_NAME', 'aws-resource-discovery')
+ASSUME_ROLE_DURATION_SECONDS = int(os.environ.get('ASSUME_ROLE_DURATION_SECONDS', '3600'))
+ASSUME_ROLE_EXTERNAL_ID = os.environ.get('ASSUME_ROLE_EXTERNAL_ID')
+DEFAULT_ASSUME_ROLE_NAME = os.environ.get('DISCOVERY_ROLE_NAME')
+STS_REGION = os.environ.get('STS_REGION', 'us-east-1')
+
+def assume_role_arn(account_id, role_name):
+    """Returns the ARN of role_name (which may include a path) in account_id."""
+    try:
+        partition = client_pool.session.get_partition_for_region(STS_REGION)
+    except Exception:
+        partition = 'aws'
+    return f'arn:{partition}:iam::{account_id}:role/{role_name.strip("/")}'
+
+def _assume_role_metadata(role_arn):
+    """Assumes role_arn with the backend's own credentials and returns botocore credential metadata."""
+    params = {
+        'RoleArn': role_arn,
+        'RoleSessionName': ASSUME_ROLE_SESSION_NAME,
+        'DurationSeconds': ASSUME_ROLE_DURATION_SECONDS,
+    }
+    if ASSUME_ROLE_EXTERNAL_ID:
+        params['ExternalId'] = ASSUME_ROLE_EXTERNAL_ID
+    credentials = call_aws(client_pool.get_client('sts', STS_REGION), 'assume_role', **params)['Credentials']
+    logging.info(f"Assumed {role_arn} until {credentials['Expiration']}.")
+    return {
+        'access_key': credentials['AccessKeyId'],
+        'secret_key': credentials['SecretAccessKey'],
+        'token': credentials['SessionToken'],
+        'expiry_time': credentials['Expiration'].isoformat(),
+    }
+
+def assumed_role_session(role_arn):
+    """Returns a botocore Session whose credentials assume role_arn and refresh before they expire."""
+    # Refreshes may happen on any discovery thread; STS is always called as the backend itself.
+    refresh = bind_unit_context(lambda: _assume_role_metadata(role_arn), client_pool)
+    session = botocore.session.Session()
+    session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=refresh(), refresh_using=refresh, method='assume-role')
+    return session
+
+class AccountContext:
+    """Client pool and region catalog of one member account reached through an assumed role."""
+
+    def __init__(self, account_id, role_name):
+        self.account_id = account_id
+        self.role_name = role_name
+        self.role_arn = assume_role_arn(account_id, role_name)
+        self.client_pool = ClientPool(session_factory=lambda: assumed_role_session(self.role_arn), name=account_id)
+        self.region_catalog = RegionCatalog(pool=self.client_pool)
+
+_account_contexts = {}
+_account_contexts_lock = threading.Lock()
+
+def get_account_context(account_id, role_name):
+    """Returns the cached AccountContext for (account_id, role_name)."""
+    key = (account_id, role_name)
+    with _account_contexts_lock:
+        context = _account_contexts.get(key)
+        if context is None:
+            context = _account_contexts[key] = AccountContext(account_id, role_name)
+        return context
+
 # --- Resource Discovery Functions ---
+# Most services are discovered the same way: stream the pages of one list/describe
+# operation, walk from each page to its items and keep a handful of fields per item.
+# Each service declares that once as a ServiceSpec (see the Service Registry below);
+# its field projection is compiled into plain Python extractors when the spec is
+# built, and every raw page is dropped as soon as its items have been projected.
 
-def discover_ec2_instances(client):
-    """Discovers EC2 instances in a given region."""
-    instances = []
+def _compile_path(path, default=None):
+    """
+    Compiles a field path into an extractor. Paths are dotted keys ('State.Name'),
+    'tag:<Key>' for the value of a tag, or '@' for the item itself. default replaces
+    missing (None) values.
+    """
+    if path == '@':
+        return lambda item: item
+    if path.startswith('tag:'):
+        tag_key = path[len('tag:'):]
+        def extract_tag(item):
+            for tag in item.get('Tags') or ():
+                if tag['Key'] == tag_key:
+                    return tag['Value']
+            return default
+        return extract_tag
+    keys = path.split('.')
+    if len(keys) == 1:
+        key = keys[0]
+        if default is None:
+            return lambda item: item.get(key)
+        def extract_key(item):
+            value = item.get(key)
+            return default if value is None else value
+        return extract_key
+    def extract_nested(item):
+        value = item
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+            if value is None:
+                return default
+        return value
+    return extract_nested
+
+def compile_projection(fields, make_record=None):
+    """
+    Compiles [(output key, path[, default]), ...] into a function that builds a record
+    from one item. make_record (a Record type with those fields) receives the values
+    positionally in its field order; without it a dict is built with keys in the
+    declared order.
+    """
+    extractors = [(field[0], _compile_path(*field[1:])) for field in fields]
+    if make_record is not None:
+        extract_field = dict(extractors)
+        extract_values = [extract_field[field] for field in make_record.__slots__]
+        def project_record(item):
+            return make_record(*[extract(item) for extract in extract_values])
+        return project_record
+    def project(item):
+        return {name: extract(item) for name, extract in extractors}
+    return project
+
+def compile_items(path):
+    """
+    Compiles a tuple of list keys, e.g. ('Reservations', 'Instances'), into a function
+    yielding the items nested under them in a response page.
+    """
+    def iter_items(page, depth=0):
+        children = page.get(path[depth]) or ()
+        if depth == len(path) - 1:
+            yield from children
+        else:
+            for child in children:
+                yield from iter_items(child, depth + 1)
+    return iter_items
+
+class ServiceSpec:
+    """
+    Declares how a service is discovered: the botocore client and operation to call, the
+    path from a response page to its items and the fields kept for each item. Services
+    that need more than one list/describe stream pass their own discover function,
+    and the Record type of the records it returns.
+    """
+
+    def __init__(self, label, client_name, operation=None, items=(), fields=(), noun=None,
+                 params=None, global_region=None, discover=None, tag_filters=False, tags_path=None,
+                 state_filter=None, state_path=None, states=(), record_type=None):
+        self.label = label
+        self.client_name = client_name
+        self.operation = operation
+        self.params = params or {}
+        self.noun = noun or f'{label} resources'
+        # Region a global service is listed from; None for regional services.
+        self.global_region = global_region
+        self.iter_items = compile_items(items) if items else None
+        self.record_type = record_type or make_record_type(f'{label}Record', [field[0] for field in fields])
+        # Services with their own discover function build their records themselves.
+        self.project = compile_projection(fields, self.record_type) if fields else None
+        self.discover = discover or (lambda client, **kwargs: discover_resources(self, client, **kwargs))
+        # How tag and state filters are applied: server-side through the operation's
+        # Filters= (tag_filters, state_filter), or on the raw items when the API has no
+        # such filter but returns the data (tags_path, state_path). states lists the
+        # service's state values, so a state filter only reaches the services it names.
+        self.tag_filters = tag_filters
+        self.tags_path = tags_path
+        self.state_filter = state_filter
+        self.state_path = state_path
+        self.states = frozenset(states)
+
+    def supports(self, filters):
+        """Returns True if this service can honour the tag and state filters."""
+        if filters.tags and not (self.tag_filters or self.tags_path):
+            return False
+        if filters.states and not self.requested_states(filters):
+            return False
+        return True
+
+    def requested_states(self, filters):
+        """Returns the filtered states that are states of this service."""
+        if not (self.state_filter or self.state_path):
+            return frozenset()
+        return filters.states & self.states
+
+    def filter_request(self, filters, include_tags=True):
+        """
+        Translates filters into keyword arguments for discover(): server-side
+        Filters= where the API supports them and an item_filter for the rest.
+        """
+        if filters is None:
+            return {}
+        server_filters = []
+        checks = []
+        if filters.tags and include_tags:
+            if self.tag_filters:
+                for key, values in filters.tags.items():
+                    if values:
+                        server_filters.append({'Name': f'tag:{key}', 'Values': list(values)})
+                    else:
+                        server_filters.append({'Name': 'tag-key', 'Values': [key]})
+            else:
+                tags_path = self.tags_path
+                checks.append(lambda item: _tags_match(item.get(tags_path), filters.tags))
+        if filters.states:
+            states = self.requested_states(filters)
+            if self.state_filter:
+                server_filters.append({'Name': self.state_filter, 'Values': sorted(states)})
+            else:
+                extract_state = _compile_path(self.state_path)
+                checks.append(lambda item: extract_state(item) in states)
+        kwargs = {}
+        if server_filters:
+            kwargs['Filters'] = server_filters
+        if checks:
+            kwargs['item_filter'] = lambda item: all(check(item) for check in checks)
+        return kwargs
+
+def _tags_match(tags, wanted):
+    """Returns True if a Key/Value tag list has every wanted key (and one of its values, if given)."""
+    tag_values = {tag['Key']: tag['Value'] for tag in tags or ()}
+    return all(key in tag_values and (not values or tag_values[key] in values) for key, values in wanted.items())
+
+def iter_resources(spec, client, item_filter=None, **params):
+    """
+    Yields the projected records of spec's operation, page by page. item_filter, if
+    given, is applied to raw items before projection. Errors propagate.
+    """
+    params = {**spec.params, **params}
+    if spec.operation in PAGINATION_TOKENS:
+        pages = paginate_aws(client, spec.operation, **params)
+    else:
+        pages = iter([call_aws(client, spec.operation, **params)])
+    for page in pages:
+        items = spec.iter_items(page)
+        if item_filter is not None:
+            items = filter(item_filter, items)
+        yield from map(spec.project, items)
+
+# Error codes that mean the backend's role is not allowed to list a service.
+ACCESS_DENIED_ERROR_CODES = ('UnauthorizedOperation', 'AccessDenied', 'AccessDeniedException')
+
+def is_access_denied(error):
+    """
+    Returns True if every reason in an incomplete unit's error (reasons joined by '; ',
+    see mark_incomplete()) is a denied permission, which retrying will not fix.
+    """
+    return all(reason.rpartition(': ')[2] in ACCESS_DENIED_ERROR_CODES for reason in error.split('; '))
+
+def discover_resources(spec, client, item_filter=None, **params):
+    """Discovers the resources of a declared service in the client's region."""
+    resources = []
+    region = client.meta.region_name
     try:
-        paginator = client.get_paginator('describe_instances')
-        for page in paginator.paginate():
-            for reservation in page['Reservations']:
-                for instance in reservation['Instances']:
-                    instance_id = instance.get('InstanceId')
-                    instance_type = instance.get('InstanceType')
-                    state = instance['State']['Name']
-                    # Extract Name tag, default to 'N/A' if not found
-                    name_tag = next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'), 'N/A')
-                    instances.append({
-                        'id': instance_id,
-                        'name': name_tag,
-                        'type': instance_type,
-                        'state': state
-                    })
-        logging.info(f"Discovered {len(instances)} EC2 instances in {client.meta.region_name}.")
+        resources.extend(iter_resources(spec, client, item_filter, **params))
+        logging.info(f"Discovered {len(resources)} {spec.noun} in {region}.")
     except ClientError as e:
-        if e.response['Error']['Code'] == 'UnauthorizedOperation':
-            logging.warning(f"Permission denied for EC2 in region {client.meta.region_name}. Skipping.")
+        mark_incomplete(e.response['Error']['Code'])
+        if e.response['Error']['Code'] in ACCESS_DENIED_ERROR_CODES:
+            logging.warning(f"Permission denied for {spec.label} in region {region}. Skipping.")
         else:
-            logging.error(f"Error discovering EC2 instances in region {client.meta.region_name}: {e}")
+            logging.error(f"Error discovering {spec.noun} in region {region}: {e}")
     except Exception as e:
-        logging.error(f"An unexpected error occurred during EC2 discovery in {client.meta.region_name}: {e}")
-    return instances
+        logging.error(f"An unexpected error occurred during {spec.label} discovery in {region}: {e}")
+        mark_incomplete(str(e))
+    return resources
 
-def discover_s3_buckets(client):
+# Per-bucket enrichment (location and public access block) runs on a small pool, and the
+# results are cached between scans for S3_BUCKET_CACHE_TTL_SECONDS.
+S3_ENRICHMENT_WORKERS = int(os.environ.get('S3_ENRICHMENT_WORKERS', '16'))
+S3_BUCKET_CACHE_TTL_SECONDS = int(os.environ.get('S3_BUCKET_CACHE_TTL_SECONDS', '3600'))
+S3_LIST_PAGE_SIZE = int(os.environ.get('S3_LIST_PAGE_SIZE', '1000'))
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire ttl_seconds after they are stored."""
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        """Returns the cached value for key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl_seconds:
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# bucket name -> (region, public access state)
+bucket_metadata_cache = TTLCache(S3_BUCKET_CACHE_TTL_SECONDS)
+
+def _describe_public_access(client, bucket_name):
+    """Returns the public access state of a bucket from its public access block."""
+    try:
+        block_public_access = call_aws(client, 'get_public_access_block', Bucket=bucket_name)
+        config = block_public_access['PublicAccessBlockConfiguration']
+        if config.get('BlockPublicAcls', False) and config.get('BlockPublicPolicy', False) and \
+           config.get('IgnorePublicAcls', False) and config.get('RestrictPublicBuckets', False):
+            return 'Private (All Public Access Blocked)'
+        return 'Potentially Public (Public Access Not Fully Blocked)'
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration':
+            return 'Potentially Public (No Public Access Block Configured)'
+        raise
+
+S3BucketRecord = make_record_type('S3BucketRecord', ('name', 'region', 'type', 'objects'))
+# With S3_OBJECT_METRICS, buckets also report sizeBytes (see apply_bucket_metrics()).
+S3BucketMetricsRecord = make_record_type('S3BucketMetricsRecord', ('name', 'region', 'type', 'objects', 'sizeBytes'))
+
+def _enrich_bucket(client, bucket):
     """
-    Discovers S3 buckets. Note: S3 buckets are global, but the API call to list them
-    is typically made against a specific region (e.g., us-east-1).
-    To get the actual region of a bucket, a separate API call is needed.
+    Builds the record for one bucket from list_buckets output, the metadata cache and,
+    when needed, get_bucket_location / get_public_access_block.
+    Returns (record, incomplete reasons).
     """
-    buckets = []
-    try:
-        response = client.list_buckets()
-        for bucket in response['Buckets']:
-            bucket_name = bucket['Name']
-            bucket_region = 'N/A' # Default
-            public_access = 'Unknown' # Default
+    bucket_name = bucket['Name']
+    reasons = []
+    cached = bucket_metadata_cache.get(bucket_name)
+    if cached is not None:
+        bucket_region, public_access = cached
+    else:
+        bucket_region = bucket.get('BucketRegion') or 'N/A' # Default
+        public_access = 'Unknown' # Default
 
-            # Get bucket location
+        # Get bucket location, unless list_buckets already returned it
+        if bucket_region == 'N/A':
             try:
-                location_response = client.get_bucket_location(Bucket=bucket_name)
+                location_response = call_aws(client, 'get_bucket_location', Bucket=bucket_name)
                 # 'LocationConstraint' can be None for us-east-1, so default to it
                 bucket_region = location_response.get('LocationConstraint') or 'us-east-1'
             except ClientError as e:
                 logging.warning(f"Could not get location for bucket {bucket_name}: {e}. Defaulting to N/A.")
+                reasons.append(f"{bucket_name}: {e.response['Error']['Code']}")
 
-            # Check public access block configuration
-            try:
-                block_public_access = client.get_public_access_block(Bucket=bucket_name)
-                config = block_public_access['PublicAccessBlockConfiguration']
-                if config.get('BlockPublicAcls', False) and config.get('BlockPublicPolicy', False) and \
-                   config.get('IgnorePublicAcls', False) and config.get('RestrictPublicBuckets', False):
-                    public_access = 'Private (All Public Access Blocked)'
-                else:
-                    public_access = 'Potentially Public (Public Access Not Fully Blocked)'
-            except ClientError as e:
-                if e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration':
-                    public_access = 'Potentially Public (No Public Access Block Configured)'
-                else:
-                    logging.warning(f"Error checking public access for {bucket_name}: {e}")
-            except Exception as e:
-                logging.error(f"An unexpected error occurred while checking S3 public access for {bucket_name}: {e}")
+        # Check public access block configuration against the bucket's own region to avoid a redirect
+        try:
+            regional_client = get_client('s3', bucket_region) if bucket_region != 'N/A' else client
+            public_access = _describe_public_access(regional_client, bucket_name)
+        except ClientError as e:
+            logging.warning(f"Error checking public access for {bucket_name}: {e}")
+            reasons.append(f"{bucket_name}: {e.response['Error']['Code']}")
+        except Exception as e:
+            logging.error(f"An unexpected error occurred while checking S3 public access for {bucket_name}: {e}")
+            reasons.append(f"{bucket_name}: {e}")
+
+        if not reasons:
+            bucket_metadata_cache.put(bucket_name, (bucket_region, public_access))
+
+    return S3BucketRecord(
+        name=bucket_name,
+        region=bucket_region,
+        type=public_access,
+        objects='N/A' # Counting objects requires list_objects_v2, which can be slow for many objects
+    ), reasons
 
+# --- S3 Storage Metrics ---
+# Counting objects with list_objects_v2 is far too slow, so object counts and sizes come
+# from the daily S3 storage metrics in CloudWatch instead. One GetMetricData call per
+# region covers up to GET_METRIC_DATA_MAX_QUERIES metrics, and values are cached for a
+# day, the metrics' natural period. Enable with export S3_OBJECT_METRICS=true.
+# BucketSizeBytes is reported per storage class; add classes to sum with e.g.
+# export S3_SIZE_STORAGE_TYPES=StandardStorage,StandardIAStorage,GlacierStorage
+S3_OBJECT_METRICS = os.environ.get('S3_OBJECT_METRICS', 'false').lower() == 'true'
+S3_METRICS_PERIOD_SECONDS = 86400
+S3_SIZE_STORAGE_TYPES = tuple(os.environ.get('S3_SIZE_STORAGE_TYPES', 'StandardStorage').split(','))
+GET_METRIC_DATA_MAX_QUERIES = 500
 
-            buckets.append({
-                'name': bucket_name,
-                'region': bucket_region,
-                'type': public_access,
-                'objects': 'N/A' # Counting objects requires list_objects_v2, which can be slow for many objects
-            })
+# bucket name -> {'objects': int or None, 'sizeBytes': int or None}
+bucket_metrics_cache = TTLCache(S3_METRICS_PERIOD_SECONDS)
+
+def _s3_metric_query(query_id, metric_name, bucket_name, storage_type):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/S3',
+                'MetricName': metric_name,
+                'Dimensions': [
+                    {'Name': 'BucketName', 'Value': bucket_name},
+                    {'Name': 'StorageType', 'Value': storage_type},
+                ],
+            },
+            'Period': S3_METRICS_PERIOD_SECONDS,
+            'Stat': 'Average',
+        },
+        'ReturnData': True,
+    }
+
+def fetch_bucket_metrics(region, bucket_names):
+    """
+    Returns {bucket name: {'objects': count, 'sizeBytes': bytes}} for buckets in one
+    region, using batched GetMetricData queries. Missing datapoints are None.
+    """
+    queries = []
+    for index, bucket_name in enumerate(bucket_names):
+        queries.append(_s3_metric_query(f'objects_{index}', 'NumberOfObjects', bucket_name, 'AllStorageTypes'))
+        for type_index, storage_type in enumerate(S3_SIZE_STORAGE_TYPES):
+            queries.append(_s3_metric_query(f'size_{index}_{type_index}', 'BucketSizeBytes', bucket_name, storage_type))
+
+    latest = {}
+    client = get_client('cloudwatch', region)
+    end_time = time.time()
+    # Datapoints are published once a day and can lag, so look back a few periods.
+    start_time = end_time - 3 * S3_METRICS_PERIOD_SECONDS
+    for batch in _batches(queries, GET_METRIC_DATA_MAX_QUERIES):
+        for page in paginate_aws(client, 'get_metric_data', MetricDataQueries=batch,
+                                 StartTime=start_time, EndTime=end_time, ScanBy='TimestampDescending'):
+            for result in page['MetricDataResults']:
+                if result.get('Values') and result['Id'] not in latest:
+                    latest[result['Id']] = result['Values'][0]
+
+    bucket_metrics = {}
+    for index, bucket_name in enumerate(bucket_names):
+        objects = latest.get(f'objects_{index}')
+        sizes = [latest[f'size_{index}_{type_index}'] for type_index in range(len(S3_SIZE_STORAGE_TYPES))
+                 if f'size_{index}_{type_index}' in latest]
+        bucket_metrics[bucket_name] = {
+            'objects': int(objects) if objects is not None else None,
+            'sizeBytes': int(sum(sizes)) if sizes else None,
+        }
+    return bucket_metrics
+
+def apply_bucket_metrics(buckets):
+    """
+    Returns S3BucketMetricsRecords for bucket records, with 'objects' and 'sizeBytes'
+    from cached or fetched metrics.
+    Metrics are best-effort enrichment: buckets whose metrics cannot be read (e.g.
+    without cloudwatch:GetMetricData) keep 'N/A', and the S3 slice stays complete.
+    """
+    by_region = {}
+    for record in buckets:
+        if bucket_metrics_cache.get(record['name']) is None and record['region'] != 'N/A':
+            by_region.setdefault(record['region'], []).append(record['name'])
+    for region, bucket_names in by_region.items():
+        try:
+            for bucket_name, bucket_metrics in fetch_bucket_metrics(region, bucket_names).items():
+                bucket_metrics_cache.put(bucket_name, bucket_metrics)
+        except Exception as e:
+            logging.warning(f"Could not get S3 storage metrics in region {region}: {e}. Leaving them N/A.")
+    records = []
+    for record in buckets:
+        bucket_metrics = bucket_metrics_cache.get(record['name']) or {}
+        objects = bucket_metrics.get('objects')
+        size_bytes = bucket_metrics.get('sizeBytes')
+        records.append(S3BucketMetricsRecord(
+            name=record['name'],
+            region=record['region'],
+            type=record['type'],
+            objects=objects if objects is not None else 'N/A',
+            sizeBytes=size_bytes if size_bytes is not None else 'N/A',
+        ))
+    return records
+
+def discover_s3_buckets(client):
+    """
+    Discovers S3 buckets. Note: S3 buckets are global, but the API call to list them
+    is typically made against a specific region (e.g., us-east-1).
+    list_buckets is paginated and usually returns each bucket's region; buckets are
+    enriched concurrently one page at a time, so only one raw page is held in memory.
+    """
+    buckets = []
+    try:
+        # Enrichment threads must call S3 as the same account as this unit.
+        enrich = bind_unit_context(lambda bucket: _enrich_bucket(client, bucket))
+        with ThreadPoolExecutor(max_workers=S3_ENRICHMENT_WORKERS, thread_name_prefix='s3-enrichment') as executor:
+            for page in paginate_aws(client, 'list_buckets', MaxBuckets=S3_LIST_PAGE_SIZE):
+                for record, reasons in executor.map(enrich, page['Buckets']):
+                    buckets.append(record)
+                    for reason in reasons:
+                        mark_incomplete(reason)
+        if S3_OBJECT_METRICS:
+            buckets = apply_bucket_metrics(buckets)
         logging.info(f"Discovered {len(buckets)} S3 buckets.")
     except ClientError as e:
-        if e.response['Error']['Code'] == 'UnauthorizedOperation':
-            logging.warning(f"Permission denied for S3. Skipping S3 discovery.")
+        mark_incomplete(e.response['Error']['Code'])
+        if e.response['Error']['Code'] in ACCESS_DENIED_ERROR_CODES:
+            logging.warning("Permission denied for S3. Skipping S3 discovery.")
         else:
             logging.error(f"Error discovering S3 buckets: {e}")
     except Exception as e:
         logging.error(f"An unexpected error occurred during S3 discovery: {e}")
+        mark_incomplete(str(e))
     return buckets
 
+# --- Service Registry ---
+# Ordered registry of discoverable services. The order here is the order services
+# appear in the JSON response for each region. Adding a service is one entry here
+# (plus its tokens in PAGINATION_TOKENS if the operation is paginated).
+
+# DBInstanceStatus values, from the RDS user guide.
+RDS_INSTANCE_STATES = (
+    'available', 'backing-up', 'configuring-enhanced-monitoring', 'configuring-iam-database-auth',
+    'configuring-log-exports', 'converting-to-vpc', 'creating', 'delete-precheck', 'deleting', 'failed',
+    'inaccessible-encryption-credentials', 'inaccessible-encryption-credentials-recoverable',
+    'incompatible-network', 'incompatible-option-group', 'incompatible-parameters', 'incompatible-restore',
+    'insufficient-capacity', 'maintenance', 'modifying', 'moving-to-vpc', 'rebooting',
+    'resetting-master-credentials', 'renaming', 'restore-error', 'starting', 'stopped', 'stopping',
+    'storage-config-upgrade', 'storage-full', 'storage-optimization', 'upgrading',
+)
+
+SERVICE_REGISTRY = [
+    ServiceSpec('EC2', 'ec2', 'describe_instances', ('Reservations', 'Instances'), [
+        ('id', 'InstanceId'),
+        ('name', 'tag:Name', 'N/A'),
+        ('type', 'InstanceType'),
+        ('state', 'State.Name'),
+    ], noun='EC2 instances', tag_filters=True, state_filter='instance-state-name',
+       states=('pending', 'running', 'shutting-down', 'terminated', 'stopping', 'stopped')),
+    # S3 buckets are listed globally, but the API call is regional.
+    # We call it once from a single region to avoid duplicate listings.
+    ServiceSpec('S3', 's3', global_region='us-east-1', discover=discover_s3_buckets,
+                record_type=S3BucketMetricsRecord if S3_OBJECT_METRICS else S3BucketRecord),
+    ServiceSpec('Lambda', 'lambda', 'list_functions', ('Functions',), [
+        ('name', 'FunctionName'),
+        ('runtime', 'Runtime'),
+        ('memory', 'MemorySize'),
+        ('arn', 'FunctionArn'),
+    ], noun='Lambda functions'),
+    ServiceSpec('RDS', 'rds', 'describe_db_instances', ('DBInstances',), [
+        ('id', 'DBInstanceIdentifier'),
+        ('engine', 'Engine'),
+        ('instanceClass', 'DBInstanceClass'),
+        ('status', 'DBInstanceStatus'),
+        ('endpoint', 'Endpoint.Address', 'N/A'),
+    ], noun='RDS instances', tags_path='TagList', state_path='DBInstanceStatus', states=RDS_INSTANCE_STATES),
+    ServiceSpec('VPC', 'ec2', 'describe_vpcs', ('Vpcs',), [
+        ('id', 'VpcId'),
+        ('name', 'tag:Name', 'N/A'),
+        ('cidr', 'CidrBlock'),
+        ('isDefault', 'IsDefault'),
+    ], noun='VPCs', tag_filters=True, state_filter='state', states=('pending', 'available')),
+    ServiceSpec('ELB', 'elbv2', 'describe_load_balancers', ('LoadBalancers',), [
+        ('name', 'LoadBalancerName'),
+        ('type', 'Type'),
+        ('scheme', 'Scheme'),
+        ('state', 'State.Code'),
+        ('dnsName', 'DNSName'),
+        ('arn', 'LoadBalancerArn'),
+    ], noun='load balancers', state_path='State.Code',
+       states=('active', 'provisioning', 'active_impaired', 'failed')),
+    ServiceSpec('DynamoDB', 'dynamodb', 'list_tables', ('TableNames',), [('name', '@')], noun='DynamoDB tables'),
+    ServiceSpec('ECS', 'ecs', 'list_clusters', ('clusterArns',), [('arn', '@')], noun='ECS clusters'),
+    ServiceSpec('EKS', 'eks', 'list_clusters', ('clusters',), [('name', '@')], noun='EKS clusters'),
+]
+SERVICE_SPECS = {spec.label: spec for spec in SERVICE_REGISTRY}
+
+# Services scanned by default. The others need extra IAM permissions, so they are
+# opted into, e.g. export DISCOVERY_EXTRA_SERVICES=ELB,DynamoDB
+DEFAULT_SERVICES = ('EC2', 'S3', 'Lambda', 'RDS', 'VPC')
+ENABLED_SERVICES = frozenset(DEFAULT_SERVICES) | frozenset(
+    label.strip() for label in os.environ.get('DISCOVERY_EXTRA_SERVICES', '').split(',') if label.strip() in SERVICE_SPECS)
+
+def enabled_service_specs():
+    """Returns the enabled service specs in registry order."""
+    return [spec for spec in SERVICE_REGISTRY if spec.label in ENABLED_SERVICES]
+
+def discover_ec2_instances(client):
+    """Discovers EC2 instances in a given region."""
+    return discover_resources(SERVICE_SPECS['EC2'], client)
+
 def discover_lambda_functions(client):
     """Discovers Lambda functions in a given region."""
-    functions = []
-    try:
-        paginator = client.get_paginator('list_functions')
-        for page in paginator.paginate():
-            for func in page['Functions']:
-                functions.append({
-                    'name': func.get('FunctionName'),
-                    'runtime': func.get('Runtime'),
-                    'memory': func.get('MemorySize'),
-                    'arn': func.get('FunctionArn')
-                })
-        logging.info(f"Discovered {len(functions)} Lambda functions in {client.meta.region_name}.")
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'UnauthorizedOperation':
-            logging.warning(f"Permission denied for Lambda in region {client.meta.region_name}. Skipping.")
-        else:
-            logging.error(f"Error discovering Lambda functions in region {client.meta.region_name}: {e}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during Lambda discovery in {client.meta.region_name}: {e}")
-    return functions
+    return discover_resources(SERVICE_SPECS['Lambda'], client)
 
 def discover_rds_instances(client):
     """Discovers RDS instances in a given region."""
-    databases = []
-    try:
-        paginator = client.get_paginator('describe_db_instances')
-        for page in paginator.paginate():
-            for db_instance in page['DBInstances']:
-                databases.append({
-                    'id': db_instance.get('DBInstanceIdentifier'),
-                    'engine': db_instance.get('Engine'),
-                    'instanceClass': db_instance.get('DBInstanceClass'),
-                    'status': db_instance.get('DBInstanceStatus'),
-                    'endpoint': db_instance.get('Endpoint', {}).get('Address', 'N/A')
-                })
-        logging.info(f"Discovered {len(databases)} RDS instances in {client.meta.region_name}.")
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'UnauthorizedOperation':
-            logging.warning(f"Permission denied for RDS in region {client.meta.region_name}. Skipping.")
-        else:
-            logging.error(f"Error discovering RDS instances in region {client.meta.region_name}: {e}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during RDS discovery in {client.meta.region_name}: {e}")
-    return databases
+    return discover_resources(SERVICE_SPECS['RDS'], client)
 
 def discover_vpcs(client):
     """Discovers VPCs in a given region."""
-    vpcs = []
+    return discover_resources(SERVICE_SPECS['VPC'], client)
+
+# --- Resource Groups Tagging API Backend ---
+# An alternative to one list/describe loop per service: a single paginated
+# get_resources stream lists the ARNs of every supported type in a region, and details
+# are then fetched only for services that have resources, with batched describe calls.
+# The Tagging API only returns resources that carry (or once carried) a tag, so
+# untagged resources are not reported by this backend.
+TAGGING_RESOURCE_TYPES = {
+    'EC2': 'ec2:instance',
+    'Lambda': 'lambda:function',
+    'RDS': 'rds:db',
+    'VPC': 'ec2:vpc',
+}
+# Maximum number of values in a single describe filter.
+DESCRIBE_FILTER_BATCH_SIZE = 100
+
+def _batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _arn_resource_type(arn):
+    """Returns the 'service:type' of an ARN, e.g. 'ec2:instance' or 'rds:db'."""
+    _, _, service, _, _, resource = arn.split(':', 5)
+    return f"{service}:{resource.split('/')[0].split(':')[0]}"
+
+def _arn_resource_id(arn):
+    """Returns the trailing resource id of an ARN, e.g. 'i-0abc' or 'my-db'."""
+    return arn.split(':', 5)[5].split('/')[-1].split(':')[-1]
+
+def list_tagged_arns(client, resource_types, tags=None):
+    """
+    Returns {resource type: [ARN, ...]} for a region from the Tagging API, optionally
+    only for resources matching tags ({key: [values]}).
+    """
+    arns = {resource_type: [] for resource_type in resource_types}
+    params = {'ResourceTypeFilters': list(resource_types)}
+    if tags:
+        params['TagFilters'] = [{'Key': key, 'Values': list(values)} if values else {'Key': key}
+                                for key, values in tags.items()]
+    for page in paginate_aws(client, 'get_resources', **params):
+        for mapping in page['ResourceTagMappingList']:
+            resource_type = _arn_resource_type(mapping['ResourceARN'])
+            if resource_type in arns:
+                arns[resource_type].append(mapping['ResourceARN'])
+    return arns
+
+def _describe_by_filter(label, filter_name, client, values, Filters=(), item_filter=None):
+    records = []
+    for batch in _batches(values, DESCRIBE_FILTER_BATCH_SIZE):
+        filters = [{'Name': filter_name, 'Values': batch}] + list(Filters)
+        records.extend(iter_resources(SERVICE_SPECS[label], client, item_filter, Filters=filters))
+    return records
+
+def _describe_ec2_instances_by_arn(client, arns, **kwargs):
+    # A filter (unlike InstanceIds=) does not fail when a tagged instance no longer exists.
+    return _describe_by_filter('EC2', 'instance-id', client, [_arn_resource_id(arn) for arn in arns], **kwargs)
+
+def _describe_lambda_functions_by_arn(client, arns, **kwargs):
+    # Lambda has no batch describe call; one list_functions stream covers every function.
+    wanted = set(arns)
+    return [record for record in iter_resources(SERVICE_SPECS['Lambda'], client, **kwargs) if record['arn'] in wanted]
+
+def _describe_rds_instances_by_arn(client, arns, **kwargs):
+    return _describe_by_filter('RDS', 'db-instance-id', client, list(arns), **kwargs)
+
+def _describe_vpcs_by_arn(client, arns, **kwargs):
+    return _describe_by_filter('VPC', 'vpc-id', client, [_arn_resource_id(arn) for arn in arns], **kwargs)
+
+# label -> (botocore client name, detail fetcher taking the ARNs of that type)
+TAGGING_DETAIL_FETCHERS = {
+    'EC2': ('ec2', _describe_ec2_instances_by_arn),
+    'Lambda': ('lambda', _describe_lambda_functions_by_arn),
+    'RDS': ('rds', _describe_rds_instances_by_arn),
+    'VPC': ('ec2', _describe_vpcs_by_arn),
+}
+
+def discover_region_via_tagging(region, labels, filters=None):
+    """
+    Discovers the given service labels in a region through the Tagging API. Tag
+    filters are applied by the Tagging API itself.
+    Returns ({label: resources}, {label: [incomplete reasons]}).
+    """
+    results = {label: [] for label in labels}
+    incomplete = {label: [] for label in labels}
     try:
-        response = client.describe_vpcs()
-        for vpc in response['Vpcs']:
-            name_tag = next((tag['Value'] for tag in vpc.get('Tags', []) if tag['Key'] == 'Name'), 'N/A')
-            vpcs.append({
-                'id': vpc.get('VpcId'),
-                'name': name_tag,
-                'cidr': vpc.get('CidrBlock'),
-                'isDefault': vpc.get('IsDefault')
-            })
-        logging.info(f"Discovered {len(vpcs)} VPCs in {client.meta.region_name}.")
+        tagging_client = get_client('resourcegroupstaggingapi', region)
+        arns = list_tagged_arns(tagging_client, [TAGGING_RESOURCE_TYPES[label] for label in labels],
+                                filters.tags if filters else None)
     except ClientError as e:
-        if e.response['Error']['Code'] == 'UnauthorizedOperation':
-            logging.warning(f"Permission denied for VPCs in region {client.meta.region_name}. Skipping.")
+        logging.error(f"Error listing tagged resources in region {region}: {e}")
+        for label in labels:
+            incomplete[label].append(e.response['Error']['Code'])
+        return results, incomplete
+    for label in labels:
+        label_arns = arns[TAGGING_RESOURCE_TYPES[label]]
+        if not label_arns:
+            continue
+        client_name, fetch_details = TAGGING_DETAIL_FETCHERS[label]
+        try:
+            kwargs = SERVICE_SPECS[label].filter_request(filters, include_tags=False)
+            results[label] = fetch_details(get_client(client_name, region), label_arns, **kwargs)
+        except ClientError as e:
+            logging.error(f"Error fetching {label} details in region {region}: {e}")
+            incomplete[label].append(e.response['Error']['Code'])
+    logging.info(f"Discovered {sum(len(r) for r in results.values())} tagged resources in {region}.")
+    return results, incomplete
+
+# --- Discovery Filters ---
+# Narrow a scan with query parameters, e.g.
+# /discover-aws?regions=eu-west-1&services=EC2&states=running&tag=Env=prod
+# Filters are pushed down into the AWS calls where the API supports it (Filters= on
+# describe_instances / describe_vpcs, TagFilters on the Tagging API) and applied to raw
+# items otherwise. A service that cannot evaluate a tag or state filter is skipped and
+# listed in X-Inventory-Skipped-Services (skippedServices in the stream summary and job
+# progress); naming such a service in services= is rejected with 400 instead.
+# Services name their states differently, so each service is filtered on the requested
+# states it has: states=running,available keeps running EC2 instances and available
+# VPCs and RDS instances, and services with none of the states are not scanned.
+
+class DiscoveryFilters:
+    """Regions, services, tags ({key: [values]}) and states to restrict discovery to."""
+
+    def __init__(self, regions=None, services=None, tags=None, states=None):
+        self.regions = frozenset(regions) if regions else None
+        self.services = frozenset(services) if services else None
+        self.tags = {key: tuple(values) for key, values in tags.items()} if tags else None
+        self.states = frozenset(states) if states else None
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Parses filters from request arguments. regions, services and states are
+        comma-separated; tag is repeatable as Key or Key=Value. Keys are split off at the
+        first '=' because they often contain ':' (aws:cloudformation:stack-name).
+        Raises ValueError for unknown services and empty tag keys.
+        """
+        def split(name):
+            return [value.strip() for value in args.get(name, '').split(',') if value.strip()]
+
+        labels = {label.lower(): label for label in SERVICE_SPECS}
+        services = []
+        for name in split('services'):
+            if name.lower() not in labels:
+                raise ValueError(f"Unknown service '{name}'. Use any of: {list(SERVICE_SPECS)}.")
+            services.append(labels[name.lower()])
+        tags = {}
+        for tag in args.getlist('tag'):
+            key, _, value = tag.partition('=')
+            if not key.strip():
+                raise ValueError(f"Invalid tag filter '{tag}'. Use tag=Key or tag=Key=Value.")
+            values = tags.setdefault(key, [])
+            if value:
+                values.append(value)
+        return cls(split('regions'), services, tags, split('states'))
+
+    def to_dict(self):
+        """Returns the filters as JSON-serialisable data, read back by from_dict()."""
+        return {
+            'regions': sorted(self.regions or ()),
+            'services': sorted(self.services or ()),
+            'tags': {key: sorted(values) for key, values in sorted((self.tags or {}).items())},
+            'states': sorted(self.states or ()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('regions'), data.get('services'), data.get('tags'), data.get('states'))
+
+    @property
+    def narrows_records(self):
+        """True when filters drop records within a (region, service) slice."""
+        return bool(self.tags or self.states)
+
+    def is_supported_by(self, spec, backend):
+        if backend == 'tagging' and spec.label in TAGGING_RESOURCE_TYPES:
+            # The Tagging API filters any supported type by tag.
+            return not self.states or spec.supports(DiscoveryFilters(states=self.states))
+        return spec.supports(self)
+
+    def unsupported_services(self, backend):
+        """
+        Returns the labels of the requested services, or of the enabled ones when
+        services is not given, that cannot honour the filters and are not scanned.
+        """
+        backend = backend or DEFAULT_DISCOVERY_BACKEND
+        if self.services:
+            specs = [spec for spec in SERVICE_REGISTRY if spec.label in self.services]
         else:
-            logging.error(f"Error discovering VPCs in region {client.meta.region_name}: {e}")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during VPC discovery in {client.meta.region_name}: {e}")
-    return vpcs
+            specs = enabled_service_specs()
+        return [spec.label for spec in specs if not self.is_supported_by(spec, backend)]
+
+    def key(self):
+        """Hashable identity of the filters, used to tell requests apart."""
+        return (self.regions, self.services,
+                tuple(sorted((key, tuple(sorted(values))) for key, values in (self.tags or {}).items())),
+                self.states)
+
+    def __eq__(self, other):
+        return isinstance(other, DiscoveryFilters) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+# --- Concurrent Discovery Engine ---
+# Each (region, service) pair is an independent unit of work. Units run on a bounded
+# thread pool so a full scan takes roughly as long as the slowest region instead of
+# the sum of all of them. Units spend nearly all their time waiting on AWS, so the
+# default pool runs every unit of a default scan of all regions at once. API limits
+# apply per region, where the rate limiter already paces calls, so a service runs in
+# every region at once unless its concurrency is capped. Limits can be tuned through
+# environment variables, e.g.
+# export DISCOVERY_MAX_WORKERS=32
+# export DISCOVERY_CONCURRENCY_EC2=8
+
+DISCOVERY_MAX_WORKERS = int(os.environ.get('DISCOVERY_MAX_WORKERS', '128'))
+# label -> maximum units of that service in flight per account, for services with a cap.
+DISCOVERY_SERVICE_CONCURRENCY = {
+    spec.label: int(os.environ[f'DISCOVERY_CONCURRENCY_{spec.label.upper()}'])
+    for spec in SERVICE_REGISTRY if f'DISCOVERY_CONCURRENCY_{spec.label.upper()}' in os.environ
+}
+
+def plan_discovery_units(regions, filters=None, backend=None):
+    """
+    Returns the ordered list of (region, service label) units to discover. Regions,
+    services and services that cannot honour the filters are never scheduled.
+    """
+    backend = backend or DEFAULT_DISCOVERY_BACKEND
+    if filters is not None and filters.regions:
+        regions = [region for region in regions if region in filters.regions]
+    if filters is not None and filters.services:
+        specs = [spec for spec in SERVICE_REGISTRY if spec.label in filters.services]
+    else:
+        specs = enabled_service_specs()
+    if filters is not None:
+        specs = [spec for spec in specs if filters.is_supported_by(spec, backend)]
+    units = []
+    for region in regions:
+        for spec in specs:
+            if spec.global_region and region != spec.global_region:
+                continue
+            if not region_catalog.is_service_available(spec.client_name, region):
+                logging.info(f"{spec.label} is not available in region {region}. Skipping.")
+                continue
+            # Where the Tagging API is missing, the tagging backend falls back to describe
+            # calls, which cannot apply every filter the Tagging API can (e.g. Lambda tags).
+            if filters is not None and not filters.is_supported_by(spec, 'describe') and \
+                    not region_catalog.is_service_available('resourcegroupstaggingapi', region):
+                logging.info(f"{spec.label} in region {region} cannot be filtered without the Tagging API. Skipping.")
+                continue
+            units.append((region, spec.label))
+    return units
+
+# 'describe' runs one list/describe loop per service; 'tagging' uses the Tagging API.
+DISCOVERY_BACKENDS = ('describe', 'tagging')
+DEFAULT_DISCOVERY_BACKEND = os.environ.get('DISCOVERY_BACKEND', 'describe')
+
+def _plan_tasks(units, backend):
+    """
+    Groups units into tasks of (region, labels, use tagging). The describe backend runs
+    each unit on its own; the tagging backend covers all Tagging API services of a
+    region in one task and falls back to describe where the Tagging API is unavailable.
+    """
+    tasks = []
+    tagged = {}
+    for region, label in units:
+        if backend == 'tagging' and label in TAGGING_RESOURCE_TYPES and \
+                region_catalog.is_service_available('resourcegroupstaggingapi', region):
+            if region not in tagged:
+                tagged[region] = []
+                tasks.append((region, tagged[region], True))
+            tagged[region].append(label)
+        else:
+            tasks.append((region, [label], False))
+    return [(region, tuple(labels), use_tagging) for region, labels, use_tagging in tasks]
+
+def _discover_task(region, labels, use_tagging, service_semaphores, filters=None, account=None, timings=None):
+    """
+    Runs one task against account (an AccountContext), or the backend's own account
+    when account is None. A describe task holds its service's concurrency slot in that
+    account while it runs. AWS calls are also recorded into timings (RequestTimings)
+    when given. Returns [(label, resources, incomplete reasons), ...].
+    """
+    pool = account.client_pool if account is not None else client_pool
+    _unit_state.client_pool = pool
+    _unit_state.timings = timings
+    started = time.monotonic()
+    try:
+        if use_tagging:
+            results, incomplete = discover_region_via_tagging(region, labels, filters)
+            return [(label, results[label], incomplete[label]) for label in labels]
+        label = labels[0]
+        spec = SERVICE_SPECS[label]
+        with service_semaphores[(pool.name, label)]:
+            client = get_client(spec.client_name, region)
+            _unit_state.incomplete = []
+            try:
+                return [(label, spec.discover(client, **spec.filter_request(filters)), _unit_state.incomplete)]
+            finally:
+                _unit_state.incomplete = None
+    finally:
+        _unit_state.client_pool = None
+        _unit_state.timings = None
+        metrics.observe('discovery_unit_duration_seconds',
+                        (('service', 'tagging' if use_tagging else labels[0]), ('region', region)),
+                        time.monotonic() - started)
+
+def _iter_tasks(task_groups, max_workers=None, service_concurrency=None, filters=None, account_concurrency=None):
+    """
+    Runs [(account, tasks), ...] on one bounded thread pool and yields
+    (account, region, label, resources, error) as units finish. Accounts take turns
+    for free slots and none has more than account_concurrency tasks in flight.
+    """
+    task_groups = [(account, list(tasks)) for account, tasks in task_groups if tasks]
+    if not task_groups:
+        return
+    # Request timings are collected on the consumer's thread (see RequestTimings).
+    timings = getattr(_unit_state, 'timings', None)
+    limits = dict(DISCOVERY_SERVICE_CONCURRENCY)
+    limits.update(service_concurrency or {})
+    # Service limits protect each account's API quotas, so every account gets its own
+    # slots. An uncapped service gets one slot per unit, so all its regions run at once.
+    service_semaphores = {}
+    for account, tasks in task_groups:
+        pool_name = (account.client_pool if account is not None else client_pool).name
+        unit_counts = {}
+        for _, labels, use_tagging in tasks:
+            if not use_tagging:
+                unit_counts[labels[0]] = unit_counts.get(labels[0], 0) + 1
+        for label, count in unit_counts.items():
+            service_semaphores[(pool_name, label)] = threading.BoundedSemaphore(max(1, limits.get(label, count)))
+    workers = max(1, min(max_workers or DISCOVERY_MAX_WORKERS, sum(len(tasks) for _, tasks in task_groups)))
+    # Only a bounded window of tasks is in flight at once, so finished results that the
+    # caller has not consumed yet (e.g. a slow streaming client) cannot pile up.
+    window = workers * 2
+    account_limit = max(1, account_concurrency or window)
+    queues = deque((account, deque(tasks)) for account, tasks in task_groups)
+    running = {}
+    in_flight = {}
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='discovery')
+    try:
+        def submit_next():
+            # Round-robin over the accounts that still have work and a free share.
+            for _ in range(len(queues)):
+                account, tasks = queues[0]
+                queues.rotate(-1)
+                if running.get(id(account), 0) >= account_limit:
+                    continue
+                region, labels, use_tagging = tasks.popleft()
+                if not tasks:
+                    queues.pop()
+                running[id(account)] = running.get(id(account), 0) + 1
+                future = executor.submit(_discover_task, region, labels, use_tagging, service_semaphores,
+                                         filters, account, timings)
+                in_flight[future] = (account, region, labels)
+                return True
+            return False
+
+        while len(in_flight) < window and submit_next():
+            pass
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                account, region, labels = in_flight.pop(future)
+                running[id(account)] -= 1
+                while len(in_flight) < window and submit_next():
+                    pass
+                try:
+                    outcomes = future.result()
+                except Exception as e:
+                    # Continue with the remaining units even if one fails
+                    logging.error(f"An unexpected error occurred during {'/'.join(labels)} discovery in region {region}: {e}")
+                    outcomes = [(label, [], [str(e)]) for label in labels]
+                for label, resources, incomplete in outcomes:
+                    unit_labels = (('service', label), ('region', region))
+                    metrics.inc('discovery_records_total', unit_labels, len(resources))
+                    if incomplete:
+                        metrics.inc('discovery_incomplete_units_total', unit_labels)
+                    yield account, region, label, resources, '; '.join(incomplete) if incomplete else None
+    finally:
+        # If the consumer stops early (e.g. a client disconnects), drop queued work.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def iter_discovery(regions, max_workers=None, service_concurrency=None, units=None, backend=None, filters=None):
+    """
+    Discovers resources concurrently and yields (region, service label, resources, error)
+    as each unit finishes, in completion order. error is None unless the unit raised or
+    was flagged incomplete, in which case resources may be partial.
+    Pass units to discover only those (region, service label) pairs, backend to pick
+    one of DISCOVERY_BACKENDS and filters (DiscoveryFilters) to narrow the scan.
+    """
+    if units is None:
+        units = plan_discovery_units(regions, filters, backend)
+    tasks = _plan_tasks(units, backend or DEFAULT_DISCOVERY_BACKEND)
+    for _, region, label, resources, error in _iter_tasks([(None, tasks)], max_workers, service_concurrency, filters):
+        yield region, label, resources, error
+
+def assemble_discovered_data(regions, results):
+    """
+    Builds the response dict from {(region, label): resources}, keeping the region and
+    service order of a sequential scan and omitting empty services and regions.
+    """
+    discovered_data = {}
+    for region in regions:
+        region_data = {}
+        for spec in SERVICE_REGISTRY:
+            resources = results.get((region, spec.label))
+            if resources:
+                region_data[spec.label] = resources
+        if region_data: # Only add region to final data if it has discovered resources
+            discovered_data[region] = region_data
+    return discovered_data
+
+def run_discovery(regions, max_workers=None, service_concurrency=None, backend=None, filters=None):
+    """Runs a concurrent discovery and returns the assembled inventory."""
+    results = {}
+    for region, label, resources, _ in iter_discovery(regions, max_workers, service_concurrency,
+                                                      backend=backend, filters=filters):
+        results[(region, label)] = resources
+    return assemble_discovered_data(regions, results)
+
+# --- Multi-Account Discovery ---
+# Many accounts are scanned as one pool of (account, region, service) units, so an
+# organization-wide scan is bounded by DISCOVERY_MAX_WORKERS rather than by the number
+# of accounts. DISCOVERY_ACCOUNT_CONCURRENCY caps the tasks one account may have in
+# flight, so free slots rotate between accounts instead of going to the largest one.
+DISCOVERY_ACCOUNT_CONCURRENCY = int(os.environ.get('DISCOVERY_ACCOUNT_CONCURRENCY', '8'))
+
+def plan_multi_account_discovery(accounts, filters=None, backend=None, max_workers=None):
+    """
+    Lists the regions of each AccountContext in parallel. Returns
+    ([(account, regions, units), ...], {account_id: error}); an account whose role
+    cannot be assumed or whose regions cannot be listed is reported in the second dict.
+    """
+    def plan(account):
+        regions = account.region_catalog.get_regions()
+        return regions, plan_discovery_units(regions, filters, backend)
+
+    plans = []
+    errors = {}
+    if not accounts:
+        return plans, errors
+    workers = max(1, min(max_workers or DISCOVERY_MAX_WORKERS, len(accounts)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='account-planning') as executor:
+        futures = [(account, executor.submit(bind_unit_context(plan, account.client_pool), account))
+                   for account in accounts]
+    for account, future in futures:
+        try:
+            regions, units = future.result()
+        except Exception as e:
+            logging.error(f"Could not plan discovery for account {account.account_id} as {account.role_arn}: {e}")
+            errors[account.account_id] = str(e)
+            continue
+        plans.append((account, regions, units))
+    return plans, errors
+
+def iter_multi_account_discovery(plans, max_workers=None, service_concurrency=None, backend=None, filters=None,
+                                 account_concurrency=None):
+    """
+    Discovers the planned units of every account on one shared pool and yields
+    (account_id, region, service label, resources, error) in completion order.
+    """
+    backend = backend or DEFAULT_DISCOVERY_BACKEND
+    task_groups = [(account, _plan_tasks(units, backend)) for account, _, units in plans]
+    for account, region, label, resources, error in _iter_tasks(
+            task_groups, max_workers, service_concurrency, filters,
+            account_concurrency or DISCOVERY_ACCOUNT_CONCURRENCY):
+        yield account.account_id, region, label, resources, error
+
+# --- Resource Fingerprints ---
+# Every stored slice keeps a fingerprint per resource, keyed by the resource's arn, id
+# or name. Comparing a new slice against the previous fingerprints is a single pass
+# over two dicts, so diffs stay linear in the size of the slice.
+
+# Record fields that identify a resource, most specific first.
+RESOURCE_KEY_FIELDS = ('arn', 'id', 'name')
+
+def resource_fingerprint(record):
+    """Returns a stable digest of a resource record's content."""
+    payload = dumps_json(record, sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=12).hexdigest()
+
+def resource_key(record, fingerprint=None):
+    """Returns the arn, id or name identifying record, or its fingerprint when it has none."""
+    for field in RESOURCE_KEY_FIELDS:
+        value = record.get(field)
+        if value and value != 'N/A':
+            return str(value)
+    return fingerprint or resource_fingerprint(record)
+
+def fingerprint_resources(resources):
+    """Returns ({resource key: fingerprint}, {resource key: record}) for a slice."""
+    fingerprints = {}
+    records = {}
+    for record in resources:
+        fingerprint = resource_fingerprint(record)
+        key = resource_key(record, fingerprint)
+        fingerprints[key] = fingerprint
+        records[key] = record
+    return fingerprints, records
+
+def diff_fingerprints(previous, current):
+    """Returns (added, removed, modified) resource keys between two fingerprint dicts."""
+    added = [key for key in current if key not in previous]
+    removed = [key for key in previous if key not in current]
+    modified = [key for key, fingerprint in current.items()
+                if key in previous and previous[key] != fingerprint]
+    return added, removed, modified
+
+# --- Inventory Snapshot Store ---
+# Discovery results are kept per (account, region, service) in a local SQLite file.
+# Within a service's TTL the snapshot is served as-is; once it is stale the snapshot
+# is still served immediately while only the expired slices are refreshed in the
+# background (stale-while-revalidate). Lambda only allows writes under /tmp.
+# On Lambda both the store and the refresh belong to one execution environment: each
+# container keeps its own snapshots, and its refresh thread is frozen once the
+# response is sent. Stale slices there are only refreshed when the same container is
+# invoked again, and until then later requests to it serve the same stale slices
+# without starting another refresh. (A separate asynchronous invocation would refresh
+# the store of whichever container ran it, not this one.)
+# Each save is recorded as a scan with the resources it added, removed or modified,
+# which feeds the change feed (/discover-aws/changes). Change history older than
+# CHANGE_FEED_RETENTION_SECONDS is pruned.
+# A slice that is incomplete only because a permission is denied (a missing IAM
+# action, an SCP denying the region, a bucket policy) is stored too, with what it
+# could read and its reason, so it is served and refreshed like any other slice
+# instead of being rescanned on every request. It is reported as incomplete and left
+# out of the change feed. Slices that ran out of retries are not stored.
+SNAPSHOT_DB_PATH = os.environ.get('SNAPSHOT_DB_PATH', os.path.join(tempfile.gettempdir(), 'aws_discovery_snapshots.sqlite3'))
+SNAPSHOT_TTL_SECONDS = int(os.environ.get('SNAPSHOT_TTL_SECONDS', '300'))
+SNAPSHOT_SERVICE_TTL_SECONDS = {
+    spec.label: int(os.environ.get(f'SNAPSHOT_TTL_{spec.label.upper()}', SNAPSHOT_TTL_SECONDS))
+    for spec in SERVICE_REGISTRY
+}
+CHANGE_FEED_RETENTION_SECONDS = int(os.environ.get('CHANGE_FEED_RETENTION_SECONDS', str(7 * 24 * 3600)))
+# Pruning scans the change table, so it runs at most this often per process.
+CHANGE_FEED_PRUNE_INTERVAL_SECONDS = 600
+
+class SnapshotStore:
+    """SQLite-backed store of discovery results keyed by (account, region, service)."""
+
+    def __init__(self, path=SNAPSHOT_DB_PATH, retention_seconds=CHANGE_FEED_RETENTION_SECONDS):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pruned_at = 0.0
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots ('
+                ' account_id TEXT NOT NULL, region TEXT NOT NULL, service TEXT NOT NULL,'
+                ' fetched_at REAL NOT NULL, resources TEXT NOT NULL, incomplete TEXT,'
+                ' PRIMARY KEY (account_id, region, service))')
+            columns = {row[1] for row in self._connection.execute('PRAGMA table_info(snapshots)')}
+            if 'incomplete' not in columns:
+                # Stores created before incomplete slices were kept.
+                self._connection.execute('ALTER TABLE snapshots ADD COLUMN incomplete TEXT')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS slice_fingerprints ('
+                ' account_id TEXT NOT NULL, region TEXT NOT NULL, service TEXT NOT NULL,'
+                ' fingerprints TEXT NOT NULL, PRIMARY KEY (account_id, region, service))')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS scans ('
+                ' scan_id INTEGER PRIMARY KEY AUTOINCREMENT, account_id TEXT NOT NULL,'
+                ' region TEXT NOT NULL, service TEXT NOT NULL, fetched_at REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS scans_by_account ON scans (account_id, scan_id)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS changes ('
+                ' scan_id INTEGER NOT NULL, account_id TEXT NOT NULL, region TEXT NOT NULL,'
+                ' service TEXT NOT NULL, resource_key TEXT NOT NULL, change TEXT NOT NULL,'
+                ' resource TEXT)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS changes_by_account ON changes (account_id, scan_id)')
+            self._connection.commit()
+        return self._connection
+
+    def save(self, account_id, region, service, resources, fetched_at=None, incomplete=None):
+        """
+        Stores the resources of one (region, service) slice, records it as a new scan
+        and logs the resources it added, removed or modified. Returns the scan id.
+        An incomplete slice (incomplete is its reason) is only stored for serving:
+        its missing resources are not removals, so it is no scan and returns None.
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        payload = dumps_json(resources)
+        if incomplete is not None:
+            with self._lock:
+                connection = self._connect()
+                connection.execute(
+                    'INSERT OR REPLACE INTO snapshots (account_id, region, service, fetched_at, resources, incomplete)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (account_id, region, service, fetched_at, payload, incomplete))
+                connection.commit()
+            return None
+        fingerprints, records = fingerprint_resources(resources)
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                'SELECT fingerprints FROM slice_fingerprints WHERE account_id = ? AND region = ? AND service = ?',
+                (account_id, region, service)).fetchone()
+            added, removed, modified = diff_fingerprints(json.loads(row[0]) if row else {}, fingerprints)
+            scan_id = connection.execute(
+                'INSERT INTO scans (account_id, region, service, fetched_at) VALUES (?, ?, ?, ?)',
+                (account_id, region, service, fetched_at)).lastrowid
+            changes = [(key, 'added', records[key]) for key in added]
+            changes += [(key, 'modified', records[key]) for key in modified]
+            changes += [(key, 'removed', None) for key in removed]
+            connection.executemany(
+                'INSERT INTO changes (scan_id, account_id, region, service, resource_key, change, resource)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(scan_id, account_id, region, service, key, change,
+                  None if record is None else dumps_json(record))
+                 for key, change, record in changes])
+            connection.execute(
+                'INSERT OR REPLACE INTO snapshots (account_id, region, service, fetched_at, resources)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (account_id, region, service, fetched_at, payload))
+            connection.execute(
+                'INSERT OR REPLACE INTO slice_fingerprints (account_id, region, service, fingerprints)'
+                ' VALUES (?, ?, ?, ?)',
+                (account_id, region, service, dumps_json(fingerprints)))
+            self._prune(connection, fetched_at)
+            connection.commit()
+        return scan_id
+
+    def _prune(self, connection, now):
+        """Drops change history older than the retention window."""
+        if now - self._pruned_at < CHANGE_FEED_PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned_at = now
+        cutoff = now - self.retention_seconds
+        row = connection.execute('SELECT MAX(scan_id) FROM scans WHERE fetched_at < ?', (cutoff,)).fetchone()
+        if row[0] is not None:
+            connection.execute('DELETE FROM changes WHERE scan_id <= ?', (row[0],))
+            connection.execute('DELETE FROM scans WHERE scan_id <= ?', (row[0],))
+
+    def latest_scan_id(self, account_id):
+        """Returns the id of account_id's most recent scan, or 0 if it has none."""
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT MAX(scan_id) FROM scans WHERE account_id = ?', (account_id,)).fetchone()
+        return row[0] or 0
+
+    def changes_since(self, account_id, since_scan=None, since_time=None):
+        """
+        Returns (changes, latest scan id) for account_id after scan since_scan or time
+        since_time, or None when that point is older than the retained history.
+        changes holds one net change per resource: a resource added and then removed
+        again is left out, one removed and added back is reported as modified.
+        """
+        with self._lock:
+            connection = self._connect()
+            if since_time is not None:
+                if since_time < time.time() - self.retention_seconds:
+                    return None
+                row = connection.execute(
+                    'SELECT MAX(scan_id) FROM scans WHERE account_id = ? AND fetched_at <= ?',
+                    (account_id, since_time)).fetchone()
+                since_scan = row[0] or 0
+            elif since_scan and not connection.execute(
+                    'SELECT 1 FROM scans WHERE account_id = ? AND scan_id = ?', (account_id, since_scan)).fetchone():
+                # Unknown or pruned cursor: the client has to resync from a full inventory.
+                return None
+            latest = connection.execute(
+                'SELECT MAX(scan_id) FROM scans WHERE account_id = ?', (account_id,)).fetchone()[0] or since_scan
+            rows = connection.execute(
+                'SELECT region, service, resource_key, change, resource FROM changes'
+                ' WHERE account_id = ? AND scan_id > ? AND scan_id <= ? ORDER BY scan_id',
+                (account_id, since_scan, latest)).fetchall()
+        # (region, service, key) -> [first change, last change, last resource]
+        net = {}
+        for region, service, key, change, resource in rows:
+            entry = net.get((region, service, key))
+            if entry is None:
+                net[(region, service, key)] = [change, change, resource]
+            else:
+                entry[1] = change
+                entry[2] = resource
+        changes = []
+        for (region, service, key), (first, last, resource) in net.items():
+            existed = first != 'added'
+            exists = last != 'removed'
+            if not existed and not exists:
+                continue
+            change = 'modified' if existed and exists else 'added' if exists else 'removed'
+            changes.append((region, service, key, change, None if resource is None else json.loads(resource)))
+        return changes, latest
+
+    def load(self, account_id):
+        """
+        Returns {(region, service): (fetched_at, resources, incomplete reason or None)}
+        for account_id.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT region, service, fetched_at, resources, incomplete FROM snapshots WHERE account_id = ?',
+                (account_id,)).fetchall()
+        return {(region, service): (fetched_at, json.loads(resources), incomplete)
+                for region, service, fetched_at, resources, incomplete in rows}
+
+    def clear(self, account_id=None):
+        """Deletes the snapshots and change history of account_id, or of every account."""
+        with self._lock:
+            connection = self._connect()
+            for table in ('snapshots', 'slice_fingerprints', 'scans', 'changes'):
+                if account_id is None:
+                    connection.execute(f'DELETE FROM {table}')
+                else:
+                    connection.execute(f'DELETE FROM {table} WHERE account_id = ?', (account_id,))
+            connection.commit()
+
+snapshot_store = SnapshotStore()
+
+# (account, region, service) slices with a background refresh in flight.
+_refreshing_slices = set()
+_refreshing_lock = threading.Lock()
+
+def snapshot_key(account_id, backend=None, role_arn=None):
+    """
+    Returns the store key for an account. The tagging backend only sees tagged
+    resources, so its snapshots are kept apart from full describe scans. Scans through
+    an assumed role are keyed by the role too: single-account requests scan with the
+    backend's own credentials whatever accountId says, so they must never share a
+    member account's snapshots.
+    """
+    backend = backend or DEFAULT_DISCOVERY_BACKEND
+    key = f'{account_id}@{role_arn}' if role_arn else account_id
+    return key if backend == 'describe' else f'{key}#{backend}'
+
+def save_slice(key, region, label, resources, error=None):
+    """
+    Stores a discovered slice under snapshot key unless it is incomplete for a reason
+    a retry may fix (see SnapshotStore.save()).
+    """
+    if error is None:
+        snapshot_store.save(key, region, label, resources)
+    elif is_access_denied(error):
+        snapshot_store.save(key, region, label, resources, incomplete=error)
+
+def is_snapshot_stale(label, fetched_at, now=None):
+    """Returns True when a slice fetched at fetched_at is older than its service TTL."""
+    now = time.time() if now is None else now
+    return now - fetched_at >= SNAPSHOT_SERVICE_TTL_SECONDS.get(label, SNAPSHOT_TTL_SECONDS)
+
+def refresh_snapshot_units(account_id, regions, units, backend=None):
+    """
+    Discovers the given units and stores them (see save_slice()). Returns
+    ({(region, label): resources}, {(region, label): reason}) where the second dict
+    holds incomplete units; those that ran out of retries keep their previous snapshot.
+    """
+    results = {}
+    incomplete = {}
+    for region, label, resources, error in iter_discovery(regions, units=units, backend=backend):
+        results[(region, label)] = resources
+        save_slice(snapshot_key(account_id, backend), region, label, resources, error)
+        if error is not None:
+            incomplete[(region, label)] = error
+    return results, incomplete
+
+def schedule_snapshot_refresh(account_id, regions, units, backend=None):
+    """
+    Refreshes stale units on a background thread, skipping slices already being
+    refreshed. On Lambda the thread only runs while this container handles requests.
+    """
+    key = snapshot_key(account_id, backend)
+    with _refreshing_lock:
+        units = [unit for unit in units if (key,) + unit not in _refreshing_slices]
+        _refreshing_slices.update((key,) + unit for unit in units)
+    if not units:
+        return
+
+    def refresh():
+        try:
+            refresh_snapshot_units(account_id, regions, units, backend)
+            logging.info(f"Refreshed {len(units)} stale inventory slices for account {account_id}.")
+        except Exception as e:
+            logging.error(f"Background inventory refresh failed for account {account_id}: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing_slices.difference_update((key,) + unit for unit in units)
+
+    threading.Thread(target=refresh, name=f'snapshot-refresh-{account_id}', daemon=True).start()
+
+def get_inventory(account_id, regions, force_refresh=False, backend=None, filters=None):
+    """
+    Returns (discovered_data, stale_units, incomplete_units) for account_id, serving
+    snapshots where possible. Missing slices are discovered synchronously; stale ones
+    are returned as-is and refreshed in the background. incomplete_units maps units
+    to their reason, including stored slices that were incomplete when scanned.
+    """
+    units = plan_discovery_units(regions, filters, backend)
+    if filters is not None and filters.narrows_records:
+        # Tag/state-filtered slices are partial, so they bypass the snapshot store.
+        results = {}
+        incomplete = {}
+        for region, label, resources, error in iter_discovery(regions, units=units, backend=backend, filters=filters):
+            results[(region, label)] = resources
+            if error is not None:
+                incomplete[(region, label)] = error
+        return assemble_discovered_data(regions, results), [], incomplete
+    cached = {} if force_refresh else snapshot_store.load(snapshot_key(account_id, backend))
+    now = time.time()
+    results = {}
+    missing = []
+    stale = []
+    incomplete = {}
+    for unit in units:
+        entry = cached.get(unit)
+        if entry is None:
+            missing.append(unit)
+            continue
+        fetched_at, resources, reason = entry
+        results[unit] = resources
+        if reason is not None:
+            incomplete[unit] = reason
+        if is_snapshot_stale(unit[1], fetched_at, now):
+            stale.append(unit)
+    if missing:
+        fetched, fetched_incomplete = refresh_snapshot_units(account_id, regions, missing, backend)
+        results.update(fetched)
+        incomplete.update(fetched_incomplete)
+    if stale:
+        schedule_snapshot_refresh(account_id, regions, stale, backend)
+    return assemble_discovered_data(regions, results), stale, incomplete
+
+def get_multi_account_inventory(accounts, backend=None, filters=None):
+    """
+    Scans every AccountContext on the shared scheduler. Returns
+    ({account_id: discovered_data}, {account_id: error}, {(account_id, region, label): reason}).
+    Slices are also saved to each account's snapshots (see save_slice()), keyed by the assumed role.
+    """
+    plans, failed = plan_multi_account_discovery(accounts, filters, backend)
+    store_results = filters is None or not filters.narrows_records
+    results = {account.account_id: {} for account, _, _ in plans}
+    role_arns = {account.account_id: account.role_arn for account, _, _ in plans}
+    incomplete = {}
+    for account_id, region, label, resources, error in iter_multi_account_discovery(plans, backend=backend,
+                                                                                     filters=filters):
+        results[account_id][(region, label)] = resources
+        if store_results:
+            save_slice(snapshot_key(account_id, backend, role_arns[account_id]), region, label, resources, error)
+        if error is not None:
+            incomplete[(account_id, region, label)] = error
+    inventory = {account.account_id: assemble_discovered_data(regions, results[account.account_id])
+                 for account, regions, _ in plans}
+    return inventory, failed, incomplete
+
+# --- Metrics and Request Timings ---
+# ?timings=true on a discovery request collects a breakdown of its AWS call time.
+# /discover-aws returns it as a Server-Timing header (shown by browser dev tools);
+# the stream adds it to its summary record.
+@app.before_request
+def _start_request_timings():
+    _unit_state.timings = RequestTimings() if request.args.get('timings', 'false').lower() == 'true' else None
+
+@app.after_request
+def _add_server_timing(response):
+    timings = getattr(_unit_state, 'timings', None)
+    # A streamed body has not run yet; its timings go into the summary record instead.
+    if timings is not None and not response.is_streamed:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+@app.teardown_request
+def _clear_request_timings(error=None):
+    _unit_state.timings = None
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Serves the AWS call and discovery metrics of this process in the Prometheus text format."""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # --- Main API Endpoint ---
+def _requested_backend():
+    """Returns the ?backend= discovery backend, or None if it is not supported."""
+    backend = request.args.get('backend', DEFAULT_DISCOVERY_BACKEND)
+    return backend if backend in DISCOVERY_BACKENDS else None
+
+def _unsupported_backend_response():
+    return jsonify({"error": f"Unsupported discovery backend. Use one of: {list(DISCOVERY_BACKENDS)}."}), 400
+
+ACCOUNT_ID_PATTERN = re.compile(r'^\d{12}$')
+ROLE_NAME_PATTERN = re.compile(r'^[\w+=,.@/-]{1,512}$')
+
+def _requested_accounts():
+    """
+    Returns ([AccountContext, ...], None) for ?accountIds=<id>,<id>&roleName=<role>,
+    (None, None) when no accountIds are given, or (None, error response).
+    roleName defaults to DISCOVERY_ROLE_NAME.
+    """
+    account_ids = [value.strip() for value in request.args.get('accountIds', '').split(',') if value.strip()]
+    if not account_ids:
+        return None, None
+    role_name = request.args.get('roleName') or DEFAULT_ASSUME_ROLE_NAME
+    if not role_name:
+        return None, (jsonify({"error": "roleName is required when accountIds are given."}), 400)
+    if not ROLE_NAME_PATTERN.match(role_name):
+        return None, (jsonify({"error": f"Invalid role name '{role_name}'."}), 400)
+    invalid = [account_id for account_id in account_ids if not ACCOUNT_ID_PATTERN.match(account_id)]
+    if invalid:
+        return None, (jsonify({"error": f"Invalid AWS account IDs: {invalid}."}), 400)
+    # dict.fromkeys drops repeated ids but keeps the requested order.
+    return [get_account_context(account_id, role_name) for account_id in dict.fromkeys(account_ids)], None
+
+def _format_scan_ids(scan_ids):
+    """Formats {account_id: scan id} as '<account id>=<scan id>,...'."""
+    return ','.join(f'{account_id}={scan_id}' for account_id, scan_id in scan_ids.items())
+
+def _multi_account_response(accounts, backend, filters):
+    keys = {account.account_id: snapshot_key(account.account_id, backend, account.role_arn) for account in accounts}
+    # Read before the inventory, so changes landing meanwhile are replayed rather than missed.
+    scan_ids = {account_id: snapshot_store.latest_scan_id(key) for account_id, key in keys.items()}
+    inventory, failed, incomplete_units = get_multi_account_inventory(accounts, backend, filters)
+    if failed and not inventory:
+        return jsonify({"error": "Could not scan any of the requested accounts. Check that the role exists "
+                                 "and trusts this backend.", "accounts": failed}), 500
+    logging.info(f"Multi-account discovery complete for {len(inventory)} accounts.")
+    response = jsonify(inventory)
+    # Per-account cursors for /discover-aws/changes?accountIds=...&sinceScan=...
+    response.headers['X-Inventory-Scan-Ids'] = _format_scan_ids({
+        account_id: scan_ids[account_id] or snapshot_store.latest_scan_id(keys[account_id])
+        for account_id in inventory})
+    response.headers['X-Inventory-Stale-Slices'] = '0'
+    if incomplete_units:
+        response.headers['X-Inventory-Incomplete-Slices'] = ','.join(
+            f'{account_id}/{region}/{label}' for account_id, region, label in incomplete_units)
+    if failed:
+        # Accounts whose role could not be assumed or whose regions could not be listed.
+        response.headers['X-Inventory-Failed-Accounts'] = ','.join(failed)
+    return _add_skipped_services_header(response, filters, backend)
+
+def _requested_filters(backend):
+    """
+    Returns (DiscoveryFilters, None), or (None, error response) for invalid filters
+    and for services named in services= that cannot honour the tag or state filters.
+    """
+    try:
+        filters = DiscoveryFilters.from_args(request.args)
+    except ValueError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+    if filters.services:
+        unsupported = filters.unsupported_services(backend)
+        if unsupported:
+            return None, (jsonify({"error": f"Services {unsupported} cannot apply the requested tag or state "
+                                            f"filters with the {backend} backend."}), 400)
+    return filters, None
+
+def _add_skipped_services_header(response, filters, backend):
+    skipped = filters.unsupported_services(backend)
+    if skipped:
+        # Services not scanned because they cannot apply the tag or state filters.
+        response.headers['X-Inventory-Skipped-Services'] = ','.join(skipped)
+    return response
+
 @app.route('/discover-aws', methods=['GET'])
 def discover_aws_resources():
     """
     API endpoint to discover AWS resources.
-    The AWS Account ID from the frontend is for logging/display.
-    Boto3 uses the credentials configured in the backend's environment or IAM role.
+    The AWS Account ID from the frontend is for logging/display and keys the snapshot store.
+    botocore uses the credentials configured in the backend's environment or IAM role.
+    Pass ?refresh=true to bypass stored snapshots and ?backend=tagging to use the
+    Resource Groups Tagging API backend. regions, services, tag and states narrow
+    the scan (see DiscoveryFilters).
+    Pass ?accountIds=<id>,<id>&roleName=<role> to scan member accounts through an
+    assumed role instead; the response is then keyed by account ID, always scanned live,
+    and X-Inventory-Scan-Ids carries a change feed cursor per account.
+    ?timings=true adds a Server-Timing header with AWS call time per operation.
     """
     aws_account_id = request.args.get('accountId', 'N/A')
+    backend = _requested_backend()
+    if backend is None:
+        return _unsupported_backend_response()
+    filters, error_response = _requested_filters(backend)
+    if error_response:
+        return error_response
+    accounts, error_response = _requested_accounts()
+    if error_response:
+        return error_response
+    if accounts is not None:
+        logging.info(f"Received multi-account discovery request for {len(accounts)} accounts.")
+        return _multi_account_response(accounts, backend, filters)
     logging.info(f"Received discovery request for AWS Account ID: {aws_account_id}")
 
-    discovered_data = {}
     regions = get_aws_regions()
 
     if not regions:
         return jsonify({"error": "Could not retrieve AWS regions. Check AWS credentials and network connectivity."}), 500
 
-    for region in regions:
-        region_data = {}
-        logging.info(f"Starting discovery in region: {region}")
-        try:
-            # Initialize clients for each service in the current region
-            ec2_client = boto3.client('ec2', region_name=region)
-            s3_client = boto3.client('s3', region_name=region)
-            lambda_client = boto3.client('lambda', region_name=region)
-            rds_client = boto3.client('rds', region_name=region)
-            # VPC client is also EC2 client
-            vpc_client = ec2_client
-
-            # Discover resources for each service
-            ec2_resources = discover_ec2_instances(ec2_client)
-            if ec2_resources:
-                region_data['EC2'] = ec2_resources
-
-            # S3 buckets are listed globally, but the API call is regional.
-            # We call it once from a specific region (e.g., us-east-1) to avoid duplicate listings.
-            # For this demo, we'll ensure S3 is only called once from us-east-1 to avoid redundancy.
-            if region == 'us-east-1': # Or any other single region you prefer for S3 listing
-                s3_resources = discover_s3_buckets(s3_client)
-                if s3_resources:
-                    region_data['S3'] = s3_resources
+    force_refresh = request.args.get('refresh', 'false').lower() == 'true'
+    # Read before the inventory, so changes landing meanwhile are replayed rather than missed.
+    scan_id = snapshot_store.latest_scan_id(snapshot_key(aws_account_id, backend))
+    discovered_data, stale_units, incomplete_units = get_inventory(aws_account_id, regions, force_refresh, backend, filters)
+    if not scan_id:
+        # No scan history yet: the slices just scanned and saved are what the inventory holds.
+        scan_id = snapshot_store.latest_scan_id(snapshot_key(aws_account_id, backend))
+
+    logging.info(f"Discovery complete for account {aws_account_id}.")
+    response = jsonify(discovered_data)
+    # Cursor for /discover-aws/changes?sinceScan=...
+    response.headers['X-Inventory-Scan-Id'] = str(scan_id)
+    # Stale slices are served immediately and refreshed in the background.
+    response.headers['X-Inventory-Stale-Slices'] = str(len(stale_units))
+    if incomplete_units:
+        # Slices whose data may be partial after retries ran out or because a permission is
+        # denied, as region/service pairs.
+        response.headers['X-Inventory-Incomplete-Slices'] = ','.join(
+            f'{region}/{label}' for region, label in incomplete_units)
+    return _add_skipped_services_header(response, filters, backend)
+
+# --- Change Feed API Endpoint ---
+def _parse_since(value):
+    """Parses ?since= as epoch seconds or an ISO 8601 timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def _change_feed(key, since_scan, since_time):
+    """Returns the change feed of snapshot key as a response dict, or None if the point has expired."""
+    feed = snapshot_store.changes_since(key, since_scan, since_time)
+    if feed is None:
+        return None
+    changes, latest_scan_id = feed
+    added, removed, modified = [], [], []
+    for region, service, resource_key, change, resource in changes:
+        entry = {'region': region, 'service': service, 'key': resource_key}
+        if change == 'removed':
+            removed.append(entry)
+        else:
+            entry['resource'] = resource
+            (added if change == 'added' else modified).append(entry)
+    return {
+        'scanId': latest_scan_id,
+        'added': added,
+        'removed': removed,
+        'modified': modified,
+    }
+
+def _parse_scan_id(value):
+    scan_id = int(value)
+    if scan_id < 0:
+        raise ValueError(value)
+    return scan_id
+
+@app.route('/discover-aws/changes', methods=['GET'])
+def discover_aws_changes():
+    """
+    Returns the resources added, removed or modified in the stored inventory of
+    accountId since ?sinceScan=<scan id> (from X-Inventory-Scan-Id or a previous
+    feed response) or ?since=<epoch seconds or ISO 8601 timestamp>. Each resource
+    appears at most once with its net change. Pass the returned scanId as the next
+    sinceScan. Answers 410 when the point is older than the retained history, in
+    which case the client should fetch /discover-aws again.
+    With ?accountIds=<id>,<id>&roleName=<role> the feed covers what multi-account
+    requests stored for those accounts: sinceScan takes one cursor per account as
+    <account id>=<scan id>,... (X-Inventory-Scan-Ids of /discover-aws) and the
+    response is keyed by account ID, with the next cursors in X-Inventory-Scan-Ids.
+    """
+    aws_account_id = request.args.get('accountId', 'N/A')
+    backend = _requested_backend()
+    if backend is None:
+        return _unsupported_backend_response()
+    accounts, error_response = _requested_accounts()
+    if error_response:
+        return error_response
+    since_scan = since_time = None
+    try:
+        if 'sinceScan' in request.args:
+            if accounts is None:
+                since_scan = _parse_scan_id(request.args['sinceScan'])
             else:
-                # For other regions, we don't re-list S3 buckets
-                pass
+                since_scan = {}
+                for cursor in request.args['sinceScan'].split(','):
+                    account_id, _, scan_id = cursor.strip().partition('=')
+                    since_scan[account_id] = _parse_scan_id(scan_id)
+        elif 'since' in request.args:
+            since_time = _parse_since(request.args['since'])
+        else:
+            return jsonify({"error": "Pass sinceScan=<scan id> or since=<timestamp>."}), 400
+    except ValueError:
+        return jsonify({"error": "sinceScan must be a scan id (0 or more), or <account id>=<scan id>,... with "
+                                 "accountIds, and since an epoch or ISO 8601 timestamp."}), 400
+
+    if accounts is None:
+        feed = _change_feed(snapshot_key(aws_account_id, backend), since_scan, since_time)
+        if feed is None:
+            return jsonify({"error": "The requested point is older than the retained change history. "
+                                     "Fetch /discover-aws for a full inventory."}), 410
+        return jsonify({'accountId': aws_account_id, **feed})
+
+    if since_scan is not None:
+        missing = [account.account_id for account in accounts if account.account_id not in since_scan]
+        if missing:
+            return jsonify({"error": f"sinceScan has no scan id for accounts {missing}."}), 400
+    feeds = {}
+    expired = []
+    for account in accounts:
+        feed = _change_feed(snapshot_key(account.account_id, backend, account.role_arn),
+                            since_scan[account.account_id] if since_scan is not None else None, since_time)
+        if feed is None:
+            expired.append(account.account_id)
+        else:
+            feeds[account.account_id] = {'accountId': account.account_id, **feed}
+    if expired:
+        return jsonify({"error": "The requested point is older than the retained change history of some accounts. "
+                                 "Fetch /discover-aws for a full inventory.", "accounts": expired}), 410
+    response = jsonify(feeds)
+    response.headers['X-Inventory-Scan-Ids'] = _format_scan_ids(
+        {account_id: feed['scanId'] for account_id, feed in feeds.items()})
+    return response
+
+# --- Streaming API Endpoint ---
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+def _format_stream_record(record, stream_format):
+    payload = dumps_json(record)
+    if stream_format == 'sse':
+        return f"event: {record['type']}\ndata: {payload}\n\n"
+    return payload + '\n'
+
+@app.route('/discover-aws/stream', methods=['GET'])
+def discover_aws_resources_stream():
+    """
+    Streaming variant of /discover-aws. Sends one 'batch' record per finished
+    (region, service) unit that found resources or is incomplete, then a final
+    'summary' record that lists the incomplete units and the services skipped
+    because they cannot apply the tag or state filters.
+    Responds with NDJSON by default, or Server-Sent Events when ?format=sse is given
+    or the client accepts text/event-stream. With ?accountIds=...&roleName=... every
+    record carries its accountId and the summary lists the accounts that failed.
+    With ?timings=true the summary also breaks down AWS call time by operation.
+    """
+    aws_account_id = request.args.get('accountId', 'N/A')
+    stream_format = request.args.get('format')
+    if stream_format is None:
+        stream_format = 'sse' if 'text/event-stream' in request.headers.get('Accept', '') else 'ndjson'
+    if stream_format not in STREAM_FORMATS:
+        return jsonify({"error": f"Unsupported stream format '{stream_format}'. Use one of: {sorted(STREAM_FORMATS)}."}), 400
+    backend = _requested_backend()
+    if backend is None:
+        return _unsupported_backend_response()
+    filters, error_response = _requested_filters(backend)
+    if error_response:
+        return error_response
+    accounts, error_response = _requested_accounts()
+    if error_response:
+        return error_response
+    # Tag/state-filtered slices are partial, so they are not written to the snapshot store.
+    store_results = not filters.narrows_records
+    if accounts is None:
+        logging.info(f"Received streaming discovery request for AWS Account ID: {aws_account_id}")
+        regions = get_aws_regions()
+        if not regions:
+            return jsonify({"error": "Could not retrieve AWS regions. Check AWS credentials and network connectivity."}), 500
+    else:
+        logging.info(f"Received streaming multi-account discovery request for {len(accounts)} accounts.")
+    timings = getattr(_unit_state, 'timings', None)
+
+    def generate():
+        # The body may be produced after the request hooks ran, so restore the timings here.
+        _unit_state.timings = timings
+        started = time.monotonic()
+        units = 0
+        resource_count = 0
+        incomplete = []
+        role_arns = {}
+        if accounts is None:
+            region_count = len(regions)
+            failed = {}
+            scan = ((aws_account_id, region, label, resources, error)
+                    for region, label, resources, error in iter_discovery(regions, backend=backend, filters=filters))
+        else:
+            plans, failed = plan_multi_account_discovery(accounts, filters, backend)
+            region_count = sum(len(account_regions) for _, account_regions, _ in plans)
+            role_arns = {account.account_id: account.role_arn for account, _, _ in plans}
+            scan = iter_multi_account_discovery(plans, backend=backend, filters=filters)
+        for account_id, region, label, resources, error in scan:
+            units += 1
+            if store_results:
+                save_slice(snapshot_key(account_id, backend, role_arns.get(account_id)), region, label, resources,
+                           error)
+            if error is not None:
+                entry = {'region': region, 'service': label, 'reason': error}
+                if accounts is not None:
+                    entry['accountId'] = account_id
+                incomplete.append(entry)
+            if not resources and error is None:
+                continue
+            resource_count += len(resources)
+            record = {'type': 'batch', 'region': region, 'service': label, 'resources': resources}
+            if accounts is not None:
+                record['accountId'] = account_id
+            if error is not None:
+                record['incomplete'] = error
+            yield _format_stream_record(record, stream_format)
+        summary = {
+            'type': 'summary',
+            'accountId': aws_account_id,
+            'regions': region_count,
+            'units': units,
+            'resources': resource_count,
+            'incomplete': incomplete,
+            'skippedServices': filters.unsupported_services(backend),
+            'durationSeconds': round(time.monotonic() - started, 3),
+        }
+        if accounts is not None:
+            summary['accounts'] = len(accounts)
+            summary['failedAccounts'] = [{'accountId': account_id, 'reason': reason}
+                                         for account_id, reason in failed.items()]
+        if timings is not None:
+            summary['timings'] = timings.summary()
+        yield _format_stream_record(summary, stream_format)
+        logging.info(f"Streaming discovery complete for account {aws_account_id}.")
+
+    response = Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[stream_format])
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies from buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# --- Asynchronous Lambda Invocations ---
+# On Lambda, work that must outlive a response cannot run on a background thread: the
+# execution environment is frozen as soon as the response is returned. Such work is
+# handed to a new asynchronous ('Event') invocation of this same function instead.
+# Zappa's handler calls the module function named by an event's 'command' key, with
+# the event as its first argument. The function's role needs lambda:InvokeFunction on
+# itself, and its timeout must cover the work (API Gateway still ends HTTP requests
+# after 29 seconds, whatever the function timeout is).
+RUNNING_ON_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+def invoke_async(function_name, **payload):
+    """
+    Runs function_name (a function of this module) with the event
+    {'command': ..., **payload} in an asynchronous invocation of this Lambda function.
+    """
+    client = client_pool.get_client('lambda', os.environ.get('AWS_REGION', 'us-east-1'))
+    event = dict(payload, command=f'{__name__}.{function_name}')
+    call_aws(client, 'invoke', FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+             Qualifier=os.environ.get('AWS_LAMBDA_FUNCTION_VERSION', '$LATEST'),
+             InvocationType='Event', Payload=dumps_json(event).encode('utf-8'))
+
+# --- Asynchronous Discovery Jobs ---
+# A full scan can outlast API Gateway's 29-second integration timeout. Jobs run the
+# scan outside the request and let the client poll for progress and results. On
+# Lambda each job runs in its own asynchronous invocation (see invoke_async()); on a
+# long-running host it runs on a background thread.
+# Polls can reach any container, so on Lambda job state lives in S3: set JOB_BUCKET to
+# a bucket the function can read and write. Progress and partial results are written
+# there every JOB_CHECKPOINT_SECONDS. Without JOB_BUCKET, jobs are kept in this
+# process, which is enough for a single long-running host.
+JOB_DEDUP_WINDOW_SECONDS = int(os.environ.get('JOB_DEDUP_WINDOW_SECONDS', '60'))
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', '3600'))
+JOB_BUCKET = os.environ.get('JOB_BUCKET')
+JOB_BUCKET_PREFIX = os.environ.get('JOB_BUCKET_PREFIX', 'discovery-jobs/')
+JOB_BUCKET_REGION = os.environ.get('JOB_BUCKET_REGION') or os.environ.get('AWS_REGION', 'us-east-1')
+JOB_CHECKPOINT_SECONDS = float(os.environ.get('JOB_CHECKPOINT_SECONDS', '2'))
+# A job that has not written progress for this long is reported as failed: its
+# invocation timed out or crashed. Lambda's maximum timeout is 15 minutes.
+JOB_STALL_SECONDS = int(os.environ.get('JOB_STALL_SECONDS', '900'))
 
-            lambda_resources = discover_lambda_functions(lambda_client)
-            if lambda_resources:
-                region_data['Lambda'] = lambda_resources
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
 
-            rds_resources = discover_rds_instances(rds_client)
-            if rds_resources:
-                region_data['RDS'] = rds_resources
+class DiscoveryJob:
+    """State of one background discovery run."""
 
-            vpc_resources = discover_vpcs(vpc_client)
-            if vpc_resources:
-                region_data['VPC'] = vpc_resources
+    def __init__(self, account_id, backend=None, filters=None):
+        self.id = uuid.uuid4().hex
+        self.account_id = account_id
+        self.backend = backend or DEFAULT_DISCOVERY_BACKEND
+        self.filters = filters or DiscoveryFilters()
+        self.status = 'pending'
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.finished_at = None
+        self.regions = []
+        self.units = []
+        self.results = {}
+        self.unit_errors = {}
+        self._lock = threading.Lock()
 
-            if region_data: # Only add region to final data if it has discovered resources
-                discovered_data[region] = region_data
+    @property
+    def dedup_key(self):
+        """Digest of the request this job answers; identical requests attach to the same job."""
+        request_key = dumps_json([self.account_id, self.backend, self.filters.to_dict()], sort_keys=True)
+        return hashlib.sha256(request_key.encode('utf-8')).hexdigest()
 
+    def run(self, checkpoint=None):
+        """
+        Runs the scan. checkpoint(job), if given, persists the job when the plan is
+        known, every JOB_CHECKPOINT_SECONDS while it runs, and at the end.
+        """
+        finished = threading.Event()
+
+        def save():
+            try:
+                checkpoint(self)
+            except Exception as e:
+                logging.error(f"Could not save progress of discovery job {self.id}: {e}")
+
+        def save_periodically():
+            while not finished.wait(JOB_CHECKPOINT_SECONDS):
+                save()
+
+        with self._lock:
+            self.status = 'running'
+        saver = None
+        if checkpoint is not None:
+            saver = threading.Thread(target=save_periodically, name=f'discovery-job-checkpoint-{self.id}', daemon=True)
+            saver.start()
+        try:
+            regions = get_aws_regions()
+            if not regions:
+                raise RuntimeError("Could not retrieve AWS regions. Check AWS credentials and network connectivity.")
+            with self._lock:
+                self.regions = regions
+                self.units = plan_discovery_units(regions, self.filters, self.backend)
+            if checkpoint is not None:
+                save()
+            for region, label, resources, error in iter_discovery(regions, units=self.units, backend=self.backend,
+                                                                  filters=self.filters):
+                with self._lock:
+                    self.results[(region, label)] = resources
+                    if error:
+                        self.unit_errors[(region, label)] = error
+                if not self.filters.narrows_records:
+                    save_slice(snapshot_key(self.account_id, self.backend), region, label, resources, error)
+            status, error = 'completed', None
+            logging.info(f"Discovery job {self.id} complete for account {self.account_id}.")
         except Exception as e:
-            logging.error(f"An unexpected error occurred during discovery in region {region}: {e}")
-            # Continue to next region even if one fails
-            # In a production app, you might want more sophisticated error reporting
+            logging.error(f"Discovery job {self.id} failed for account {self.account_id}: {e}")
+            status, error = 'failed', str(e)
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.finished_at = time.time()
+        finished.set()
+        if saver is not None:
+            # A periodic save still in flight must not land after the final one.
+            saver.join()
+            save()
 
-    logging.info(f"Discovery complete for account {aws_account_id}.")
-    return jsonify(discovered_data)
+    def fail(self, error):
+        """Marks the job as failed with error."""
+        with self._lock:
+            self.status = 'failed'
+            self.error = error
+            self.finished_at = time.time()
+
+    @property
+    def is_finished(self):
+        return self.status in ('completed', 'failed')
+
+    def inventory(self):
+        """Returns the inventory assembled from the units finished so far."""
+        with self._lock:
+            return assemble_discovered_data(self.regions, dict(self.results))
+
+    def to_document(self):
+        """Returns the whole job, results included, as JSON-serialisable data."""
+        with self._lock:
+            return {
+                'jobId': self.id,
+                'accountId': self.account_id,
+                'backend': self.backend,
+                'filters': self.filters.to_dict(),
+                'status': self.status,
+                'error': self.error,
+                'createdAt': self.created_at,
+                'updatedAt': time.time(),
+                'finishedAt': self.finished_at,
+                'regions': list(self.regions),
+                'units': [list(unit) for unit in self.units],
+                'results': [{'region': region, 'service': label, 'resources': resources}
+                            for (region, label), resources in self.results.items()],
+                'errors': [{'region': region, 'service': label, 'reason': reason}
+                           for (region, label), reason in self.unit_errors.items()],
+            }
+
+    @classmethod
+    def from_document(cls, document):
+        """Rebuilds a job saved with to_document()."""
+        job = cls(document['accountId'], document['backend'], DiscoveryFilters.from_dict(document['filters']))
+        job.id = document['jobId']
+        job.status = document['status']
+        job.error = document['error']
+        job.created_at = document['createdAt']
+        job.updated_at = document['updatedAt']
+        job.finished_at = document['finishedAt']
+        job.regions = document['regions']
+        job.units = [tuple(unit) for unit in document['units']]
+        job.results = {(entry['region'], entry['service']): entry['resources'] for entry in document['results']}
+        job.unit_errors = {(entry['region'], entry['service']): entry['reason'] for entry in document['errors']}
+        return job
+
+    def progress(self):
+        """Returns a JSON-serialisable progress report."""
+        with self._lock:
+            done = set(self.results)
+            pending = [unit for unit in self.units if unit not in done]
+            pending_regions = {region for region, _ in pending}
+            return {
+                'jobId': self.id,
+                'accountId': self.account_id,
+                'backend': self.backend,
+                'status': self.status,
+                'error': self.error,
+                'createdAt': self.created_at,
+                'finishedAt': self.finished_at,
+                'progress': {
+                    'unitsTotal': len(self.units),
+                    'unitsDone': len(done),
+                    'regionsDone': [region for region in self.regions if region not in pending_regions],
+                    'regionsPending': [region for region in self.regions if region in pending_regions],
+                    'pending': [{'region': region, 'service': label} for region, label in pending],
+                    'errors': len(self.unit_errors),
+                    'incomplete': [{'region': region, 'service': label, 'reason': reason}
+                                   for (region, label), reason in self.unit_errors.items()],
+                    'skippedServices': self.filters.unsupported_services(self.backend),
+                },
+            }
+
+class MemoryJobStore:
+    """Keeps jobs in this process, for a single long-running host."""
+
+    def __init__(self, retention_seconds=JOB_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._dedup_index = {}
+
+    def _expire(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.is_finished and now - job.finished_at > self.retention_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def save(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire(time.time())
+            return self._jobs.get(job_id)
+
+    def claim(self, job, can_attach):
+        """
+        Stores job as the job for its request and returns None, or returns the stored
+        job it should attach to instead (one for which can_attach(job) is True).
+        """
+        with self._lock:
+            self._expire(time.time())
+            existing = self._jobs.get(self._dedup_index.get(job.dedup_key))
+            if existing is not None and can_attach(existing):
+                return existing
+            self._jobs[job.id] = job
+            self._dedup_index[job.dedup_key] = job.id
+            return None
+
+    def begin(self, job_id):
+        """Returns the job to run, or None unless it is still pending."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != 'pending':
+                return None
+            job.status = 'running'
+            return job
+
+# S3 answers a conditional write that lost a race with 412 or 409.
+CONDITIONAL_WRITE_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+class S3JobStore:
+    """
+    Keeps each job as one JSON object in an S3 bucket, with an index from request to
+    job, so every container sees the same jobs. Conditional writes keep two containers
+    from starting or running the same job twice. Finished jobs are hidden after the
+    retention period; add a lifecycle rule on the prefix to delete them.
+    """
+
+    def __init__(self, bucket, prefix=JOB_BUCKET_PREFIX, region=JOB_BUCKET_REGION,
+                 retention_seconds=JOB_RETENTION_SECONDS, stall_seconds=JOB_STALL_SECONDS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.retention_seconds = retention_seconds
+        self.stall_seconds = stall_seconds
+
+    def _job_key(self, job_id):
+        return f'{self.prefix}jobs/{job_id}.json'
+
+    def _read(self, key):
+        """Returns (document, ETag) of an object, or (None, None) if it does not exist."""
+        client = client_pool.get_client('s3', self.region)
+        try:
+            response = call_aws(client, 'get_object', Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def _write(self, key, document, **conditions):
+        client = client_pool.get_client('s3', self.region)
+        call_aws(client, 'put_object', Bucket=self.bucket, Key=key, Body=dumps_json(document).encode('utf-8'),
+                 ContentType='application/json', **conditions)
+
+    def save(self, job):
+        self._write(self._job_key(job.id), job.to_document())
+
+    def get(self, job_id):
+        document, _ = self._read(self._job_key(job_id))
+        if document is None:
+            return None
+        job = DiscoveryJob.from_document(document)
+        now = time.time()
+        if job.is_finished and now - job.finished_at > self.retention_seconds:
+            return None
+        if not job.is_finished and now - job.updated_at > self.stall_seconds:
+            job.status = 'failed'
+            job.error = "The job stopped reporting progress before it finished."
+        return job
+
+    def claim(self, job, can_attach):
+        """See MemoryJobStore.claim()."""
+        index_key = f'{self.prefix}requests/{job.dedup_key}.json'
+        saved = False
+        while True:
+            index, etag = self._read(index_key)
+            if index is not None:
+                existing = self.get(index['jobId'])
+                if existing is not None and can_attach(existing):
+                    return existing
+            if not saved:
+                # The job must exist before the index points to it.
+                self.save(job)
+                saved = True
+            try:
+                self._write(index_key, {'jobId': job.id}, **({'IfMatch': etag} if etag else {'IfNoneMatch': '*'}))
+                return None
+            except ClientError as e:
+                if e.response['Error']['Code'] not in CONDITIONAL_WRITE_ERROR_CODES:
+                    raise
+                # Another container indexed a job for the same request first; look again.
+
+    def begin(self, job_id):
+        """See MemoryJobStore.begin()."""
+        key = self._job_key(job_id)
+        document, etag = self._read(key)
+        if document is None or document['status'] != 'pending':
+            return None
+        job = DiscoveryJob.from_document(document)
+        job.status = 'running'
+        try:
+            self._write(key, job.to_document(), IfMatch=etag)
+        except ClientError as e:
+            if e.response['Error']['Code'] in CONDITIONAL_WRITE_ERROR_CODES:
+                return None
+            raise
+        return job
+
+class JobManager:
+    """Starts discovery jobs in a job store and deduplicates concurrent requests per account."""
+
+    def __init__(self, store, dedup_window_seconds=JOB_DEDUP_WINDOW_SECONDS):
+        self.store = store
+        self.dedup_window_seconds = dedup_window_seconds
+
+    def start(self, account_id, backend=None, filters=None):
+        """
+        Starts a discovery job for account_id and returns (job, created). A job that is
+        still running, or that started within the dedup window, is returned instead
+        of starting another scan.
+        """
+        now = time.time()
+
+        def can_attach(job):
+            if job.status == 'failed':
+                return False
+            return not job.is_finished or now - job.created_at < self.dedup_window_seconds
+
+        job = DiscoveryJob(account_id, backend, filters)
+        existing = self.store.claim(job, can_attach)
+        if existing is not None:
+            return existing, False
+        try:
+            if RUNNING_ON_LAMBDA:
+                invoke_async('run_discovery_job', jobId=job.id)
+            else:
+                threading.Thread(target=self.run, args=(job.id,), name=f'discovery-job-{job.id}', daemon=True).start()
+        except Exception as e:
+            logging.error(f"Could not start discovery job {job.id}: {e}")
+            job.fail(f"Could not start the job: {e}")
+            self.store.save(job)
+        return job, True
+
+    def run(self, job_id):
+        """Runs a pending job to completion in the calling thread."""
+        job = self.store.begin(job_id)
+        if job is None:
+            # Lambda may deliver an asynchronous event more than once.
+            logging.info(f"Discovery job {job_id} is unknown or already started. Skipping.")
+            return
+        job.run(self.store.save)
+
+    def get(self, job_id):
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        return self.store.get(job_id)
+
+job_manager = JobManager(S3JobStore(JOB_BUCKET) if JOB_BUCKET else MemoryJobStore())
+
+def run_discovery_job(event, context=None):
+    """Runs the job event['jobId']: the target of the invocation that starts a job on Lambda."""
+    job_manager.run(event['jobId'])
+
+@app.route('/discover-aws/jobs', methods=['POST'])
+def start_discovery_job():
+    """
+    Starts (or attaches to) a background discovery job and returns its id.
+    Filters are read from the query string, as for /discover-aws.
+    """
+    if RUNNING_ON_LAMBDA and not JOB_BUCKET:
+        return jsonify({"error": "Discovery jobs on Lambda need JOB_BUCKET, an S3 bucket shared by every "
+                                 "container, to keep their progress and results."}), 500
+    body = request.get_json(silent=True) or {}
+    aws_account_id = body.get('accountId') or request.args.get('accountId', 'N/A')
+    backend = body.get('backend') or request.args.get('backend', DEFAULT_DISCOVERY_BACKEND)
+    if backend not in DISCOVERY_BACKENDS:
+        return _unsupported_backend_response()
+    filters, error_response = _requested_filters(backend)
+    if error_response:
+        return error_response
+    job, created = job_manager.start(aws_account_id, backend, filters)
+    if job.status == 'failed' and created:
+        return jsonify({"error": job.error, "jobId": job.id}), 500
+    logging.info(f"{'Started' if created else 'Attached to'} discovery job {job.id} for AWS Account ID: {aws_account_id}")
+    response = jsonify({**job.progress(), 'attached': not created})
+    response.status_code = 202
+    response.headers['Location'] = f'/discover-aws/jobs/{job.id}'
+    return response
+
+@app.route('/discover-aws/jobs/<job_id>', methods=['GET'])
+def get_discovery_job(job_id):
+    """Returns job progress. Partial results are included unless ?partial=false."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown discovery job '{job_id}'."}), 404
+    report = job.progress()
+    if request.args.get('partial', 'true').lower() != 'false':
+        report['partialResults'] = job.inventory()
+    return jsonify(report)
+
+@app.route('/discover-aws/jobs/<job_id>/result', methods=['GET'])
+def get_discovery_job_result(job_id):
+    """Returns the final inventory, or 202 with progress while the job is still running."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown discovery job '{job_id}'."}), 404
+    if job.status == 'failed':
+        return jsonify({"error": job.error, "jobId": job.id}), 500
+    if not job.is_finished:
+        return jsonify(job.progress()), 202
+    return jsonify(job.inventory())
+
+# --- Startup Preloading ---
+# On Lambda this module is imported once per execution environment, in the init phase
+# before the first invocation, and warm invocations reuse the clients built here.
+# Building a client loads its service model (over 100 ms for EC2, once per Session) and
+# resolves its endpoint (about 2 ms per region with shared client classes), so preloading
+# moves that work for every client a default scan needs into init and the first request
+# only pays for its API calls. Clients are built one at a time under the pool's lock;
+# building them on request threads instead costs the same CPU and more lock contention.
+# STARTUP_PRELOAD=auto (the default) preloads only when running on Lambda; true/false
+# force it on or off. STARTUP_PRELOAD_REGIONS=all covers every enabled region, which
+# costs one describe_regions call that also fills the region cache; a comma-separated
+# list covers just those regions and makes no API calls. The init-time call is made
+# once with short timeouts, so an unreachable endpoint cannot hold init past
+# Lambda's limit; preloading then falls back to the Lambda's own region.
+STARTUP_PRELOAD = os.environ.get('STARTUP_PRELOAD', 'auto').lower()
+STARTUP_PRELOAD_REGIONS = os.environ.get('STARTUP_PRELOAD_REGIONS', 'all')
+STARTUP_CLIENT_CONFIG = CLIENT_CONFIG.merge(Config(
+    connect_timeout=float(os.environ.get('STARTUP_CONNECT_TIMEOUT_SECONDS', '2')),
+    read_timeout=float(os.environ.get('STARTUP_READ_TIMEOUT_SECONDS', '3')),
+))
+
+def startup_preload_enabled():
+    """Returns True if clients should be built when the module is imported."""
+    if STARTUP_PRELOAD == 'auto':
+        return RUNNING_ON_LAMBDA
+    return STARTUP_PRELOAD == 'true'
+
+def _startup_regions():
+    """Returns the enabled regions, listed in one short-timeout call, or the Lambda's own region."""
+    try:
+        region_catalog.refresh(client_pool.session.create_client('ec2', region_name='us-east-1', config=STARTUP_CLIENT_CONFIG))
+        return region_catalog.get_regions()
+    except Exception:
+        logging.warning("Could not list AWS regions during startup. Preloading the local region only.", exc_info=True)
+        return [os.environ.get('AWS_REGION') or 'us-east-1']
+
+def preload_clients(regions=None, backend=None):
+    """
+    Builds the pooled clients a default scan of regions needs (all enabled regions if
+    None), loading their service and paginator models. Returns the number of clients.
+    """
+    backend = backend or DEFAULT_DISCOVERY_BACKEND
+    if regions is None:
+        regions = _startup_regions()
+    clients = {('ec2', 'us-east-1'): None}  # Used by the region catalog.
+    for region, labels, use_tagging in _plan_tasks(plan_discovery_units(regions, backend=backend), backend):
+        if use_tagging:
+            clients[('resourcegroupstaggingapi', region)] = 'get_resources'
+        for label in labels:
+            spec = SERVICE_SPECS[label]
+            clients[(spec.client_name, region)] = spec.operation
+            if label == 'S3' and S3_OBJECT_METRICS:
+                clients.update((('cloudwatch', bucket_region), None) for bucket_region in regions)
+    for (service_name, region), operation in clients.items():
+        client = client_pool.get_client(service_name, region)
+        if operation is not None:
+            client.can_paginate(operation)
+    return len(clients)
+
+def _preload_at_startup():
+    if not startup_preload_enabled():
+        return
+    started = time.perf_counter()
+    regions = None
+    if STARTUP_PRELOAD_REGIONS.strip().lower() != 'all':
+        regions = [region.strip() for region in STARTUP_PRELOAD_REGIONS.split(',') if region.strip()]
+    try:
+        count = preload_clients(regions)
+    except Exception:
+        logging.warning("Startup preloading failed. Clients will be built on first use.", exc_info=True)
+        return
+    logging.info(f"Preloaded {count} AWS clients in {time.perf_counter() - started:.2f}s.")
+
+_preload_at_startup()
 
 # --- Run the Flask app ---
 if __name__ == '__main__':
@@ -59,7 +59,7 @@ const App = () => {
     setError(null); // Clear previous errors
 
     try {
-      const backendUrl = `http://127.0.0.1:5000/discover-aws?accountId=${awsAccountId}`;
+      const backendUrl = `http://127.0.0.1:5000/discover-aws/stream?accountId=${awsAccountId}`;
       console.log(`Attempting to fetch from: ${backendUrl}`);
 
       const response = await fetch(backendUrl);
@@ -79,8 +79,30 @@ const App = () => {
         return; // Exit after setting demo data
       }
 
-      const data = await response.json();
-      setDiscoveredResources(data);
+      // The stream sends one NDJSON record per finished (region, service) batch,
+      // so results are rendered as soon as each region/service completes.
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      const data = {};
+      let buffer = '';
+      const applyRecord = (line) => {
+        if (!line.trim()) return;
+        const record = JSON.parse(line);
+        if (record.type === 'batch') {
+          data[record.region] = { ...(data[record.region] || {}), [record.service]: record.resources };
+          setDiscoveredResources({ ...data });
+        }
+      };
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(applyRecord);
+      }
+      applyRecord(buffer);
+      setDiscoveredResources({ ...data });
 
     } catch (err) {
       console.error("Discovery error (network/other issue):", err);
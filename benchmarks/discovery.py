@@ -0,0 +1,259 @@
+"""
+Offline benchmark of the discovery engine against a simulated AWS:
+
+    python benchmarks/discovery.py --regions 8 --resources 500 --page-size 100 \
+        --latency-ms 40 --throttle-rate 0.02
+
+No network access or credentials are needed. Every API call is answered by a
+botocore 'before-call' hook, the same mechanism botocore's Stubber uses, from a
+synthetic inventory. The hook sleeps for the configured latency, paginates at the
+configured page size and rejects a share of calls with Throttling errors.
+
+Each discover_* function is run on its own, then a full GET /discover-aws. The
+benchmark reports wall time, API calls, throttles, records, bytes serialised and
+peak RSS. Pass --json to print the results as one JSON document for CI comparisons.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from botocore import xform_name  # noqa: E402
+from botocore.awsrequest import AWSResponse  # noqa: E402
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--regions', type=int, default=4, help='Regions returned by describe_regions.')
+    parser.add_argument('--resources', type=int, default=200, help='Resources per service and region.')
+    parser.add_argument('--buckets', type=int, default=None, help='S3 buckets (default: --resources).')
+    parser.add_argument('--page-size', type=int, default=100, help='Items per simulated response page.')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Simulated latency of every call.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of calls rejected with Throttling.')
+    parser.add_argument('--services', default=None,
+                        help='Comma-separated service labels (default: every registered service).')
+    parser.add_argument('--retry-base-delay', type=float, default=None,
+                        help='Overrides RETRY_BASE_DELAY_SECONDS for the run.')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON.')
+    return parser.parse_args()
+
+def peak_rss_mib():
+    # ru_maxrss is reported in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class SimulatedAWS:
+    """Answers discovery API calls from a synthetic inventory."""
+
+    def __init__(self, regions, resources, buckets, page_size, latency_seconds, throttle_rate, seed,
+                 pagination_tokens):
+        self.regions = regions
+        self.resources = resources
+        self.buckets = buckets
+        self.page_size = page_size
+        self.latency_seconds = latency_seconds
+        self.throttle_rate = throttle_rate
+        self.pagination_tokens = pagination_tokens
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def install(self, session):
+        """Registers the simulation on a botocore Session; clients created afterwards use it."""
+        session.register('before-parameter-build', self._capture_params)
+        session.register('before-call', self._respond)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    @staticmethod
+    def _capture_params(params, context, **kwargs):
+        context['simulated_params'] = dict(params)
+
+    def _respond(self, model, context, **kwargs):
+        operation = xform_name(model.name)
+        service = model.service_model.service_name
+        region = context['client_region']
+        params = context.get('simulated_params', {})
+        with self._lock:
+            self.calls[(service, operation)] += 1
+            throttle = self._random.random() < self.throttle_rate
+            if throttle:
+                self.throttled[(service, operation)] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if throttle:
+            return AWSResponse(None, 400, {}, None), {
+                'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                'ResponseMetadata': {'HTTPStatusCode': 400},
+            }
+        handler = getattr(self, f'_{service}_{operation}', None)
+        if handler is None:
+            raise NotImplementedError(f'The simulation does not implement {service}.{operation}.')
+        return AWSResponse(None, 200, {}, None), dict(handler(region, params),
+                                                     ResponseMetadata={'HTTPStatusCode': 200})
+
+    def _page(self, operation, params, make_item, total, region, key):
+        """Returns one page of total items under key, following the operation's tokens."""
+        input_token, output_token = self.pagination_tokens[operation]
+        start = int(params.get(input_token) or 0)
+        end = min(total, start + self.page_size)
+        page = {key: [make_item(region, index) for index in range(start, end)]}
+        if end < total:
+            page[output_token] = str(end)
+        return page
+
+    def _ec2_describe_regions(self, region, params):
+        return {'Regions': [{'RegionName': name, 'OptInStatus': 'opt-in-not-required'} for name in self.regions]}
+
+    def _ec2_describe_instances(self, region, params):
+        page = self._page('describe_instances', params, lambda region, index: {'Instances': [{
+            'InstanceId': f'i-{abs(hash((region, index))) % 16 ** 17:017x}',
+            'InstanceType': ('t3.micro', 'm5.large', 'c6g.xlarge')[index % 3],
+            'State': {'Name': ('running', 'stopped')[index % 2], 'Code': 16},
+            'Tags': [{'Key': 'Name', 'Value': f'{region}-instance-{index}'}],
+        }]}, self.resources, region, 'Reservations')
+        return page
+
+    def _ec2_describe_vpcs(self, region, params):
+        return self._page('describe_vpcs', params, lambda region, index: {
+            'VpcId': f'vpc-{index:017x}', 'CidrBlock': f'10.{index % 256}.0.0/16', 'IsDefault': index == 0,
+            'Tags': [{'Key': 'Name', 'Value': f'{region}-vpc-{index}'}],
+        }, self.resources, region, 'Vpcs')
+
+    def _rds_describe_db_instances(self, region, params):
+        return self._page('describe_db_instances', params, lambda region, index: {
+            'DBInstanceIdentifier': f'db-{index}', 'Engine': 'postgres', 'DBInstanceClass': 'db.t3.medium',
+            'DBInstanceStatus': 'available', 'Endpoint': {'Address': f'db-{index}.{region}.rds.example'},
+        }, self.resources, region, 'DBInstances')
+
+    def _lambda_list_functions(self, region, params):
+        return self._page('list_functions', params, lambda region, index: {
+            'FunctionName': f'function-{index}', 'Runtime': 'python3.12', 'MemorySize': 128,
+            'FunctionArn': f'arn:aws:lambda:{region}:123456789012:function:function-{index}',
+        }, self.resources, region, 'Functions')
+
+    def _elbv2_describe_load_balancers(self, region, params):
+        return self._page('describe_load_balancers', params, lambda region, index: {
+            'LoadBalancerName': f'lb-{index}', 'Type': 'application', 'Scheme': 'internet-facing',
+            'State': {'Code': 'active'}, 'DNSName': f'lb-{index}.{region}.elb.example',
+            'LoadBalancerArn': f'arn:aws:elasticloadbalancing:{region}:123456789012:loadbalancer/app/lb-{index}',
+        }, self.resources, region, 'LoadBalancers')
+
+    def _dynamodb_list_tables(self, region, params):
+        return self._page('list_tables', params, lambda region, index: f'table-{index}',
+                          self.resources, region, 'TableNames')
+
+    def _ecs_list_clusters(self, region, params):
+        return self._page('list_clusters', params,
+                          lambda region, index: f'arn:aws:ecs:{region}:123456789012:cluster/cluster-{index}',
+                          self.resources, region, 'clusterArns')
+
+    def _eks_list_clusters(self, region, params):
+        return self._page('list_clusters', params, lambda region, index: f'cluster-{index}',
+                          self.resources, region, 'clusters')
+
+    def _s3_list_buckets(self, region, params):
+        return self._page('list_buckets', params, lambda region, index: {
+            'Name': f'bucket-{index}', 'BucketRegion': self.regions[index % len(self.regions)],
+        }, self.buckets, region, 'Buckets')
+
+    def _s3_get_bucket_location(self, region, params):
+        index = int(params['Bucket'].rsplit('-', 1)[1])
+        return {'LocationConstraint': self.regions[index % len(self.regions)]}
+
+    def _s3_get_public_access_block(self, region, params):
+        return {'PublicAccessBlockConfiguration': {
+            'BlockPublicAcls': True, 'BlockPublicPolicy': True, 'IgnorePublicAcls': True,
+            'RestrictPublicBuckets': True,
+        }}
+
+    def _cloudwatch_get_metric_data(self, region, params):
+        return {'MetricDataResults': [{'Id': query['Id'], 'Values': [1024.0]}
+                                      for query in params['MetricDataQueries']]}
+
+def measure(simulation, run):
+    """Runs run() and returns (its result, wall seconds, calls, throttled calls)."""
+    simulation.reset_counters()
+    started = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - started, sum(simulation.calls.values()), sum(simulation.throttled.values())
+
+def main():
+    args = parse_args()
+    # Module-level settings are read at import time, so configure the environment first.
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ['SNAPSHOT_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='discovery-benchmark-'), 'snapshots.sqlite3')
+    if args.retry_base_delay is not None:
+        os.environ['RETRY_BASE_DELAY_SECONDS'] = str(args.retry_base_delay)
+    import logging
+    import awsbackend
+    logging.getLogger().setLevel(logging.WARNING)
+
+    session = awsbackend.client_pool.session
+    known_regions = sorted(session.get_available_regions('ec2'))
+    regions = (['us-east-1'] + [name for name in known_regions if name != 'us-east-1'])[:args.regions]
+    simulation = SimulatedAWS(regions, args.resources, args.buckets if args.buckets is not None else args.resources,
+                              args.page_size, args.latency_ms / 1000, args.throttle_rate, args.seed,
+                              awsbackend.PAGINATION_TOKENS)
+    simulation.install(session)
+
+    labels = args.services.split(',') if args.services else [spec.label for spec in awsbackend.SERVICE_REGISTRY]
+    results = {'config': vars(args), 'functions': [], 'endpoint': None}
+
+    for label in labels:
+        spec = awsbackend.SERVICE_SPECS[label]
+        region = spec.global_region or regions[0]
+        awsbackend.bucket_metadata_cache.clear()
+        client = awsbackend.get_client(spec.client_name, region)
+        records, seconds, calls, throttled = measure(simulation, lambda: spec.discover(client))
+        results['functions'].append({
+            'service': label, 'region': region, 'seconds': round(seconds, 3), 'calls': calls,
+            'throttled': throttled, 'records': len(records), 'bytes': len(awsbackend.dumps_json(records)),
+        })
+
+    awsbackend.bucket_metadata_cache.clear()
+    awsbackend.region_catalog.clear()
+    awsbackend.snapshot_store.clear()
+    client = awsbackend.app.test_client()
+    response, seconds, calls, throttled = measure(
+        simulation, lambda: client.get(f"/discover-aws?refresh=true&services={','.join(labels)}"))
+    if response.status_code != 200:
+        sys.exit(f'/discover-aws failed with {response.status_code}: {response.get_data(as_text=True)[:500]}')
+    inventory = response.get_json()
+    incomplete = response.headers.get('X-Inventory-Incomplete-Slices')
+    results['endpoint'] = {
+        'regions': len(regions), 'seconds': round(seconds, 3), 'calls': calls, 'throttled': throttled,
+        'records': sum(len(resources) for services in inventory.values() for resources in services.values()),
+        'bytes': len(response.get_data()),
+        'incompleteSlices': len(incomplete.split(',')) if incomplete else 0,
+        'peakRssMiB': round(peak_rss_mib(), 1),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"regions={len(regions)} resources={args.resources} page_size={args.page_size} "
+          f"latency={args.latency_ms}ms throttle_rate={args.throttle_rate}")
+    print(f"{'function':<12}{'region':<16}{'seconds':>9}{'calls':>8}{'throttled':>11}{'records':>9}{'bytes':>11}")
+    for row in results['functions']:
+        print(f"{row['service']:<12}{row['region']:<16}{row['seconds']:>9.3f}{row['calls']:>8}"
+              f"{row['throttled']:>11}{row['records']:>9}{row['bytes']:>11}")
+    endpoint = results['endpoint']
+    print(f"\n/discover-aws: {endpoint['seconds']:.3f}s, {endpoint['calls']} calls ({endpoint['throttled']} throttled), "
+          f"{endpoint['records']} records, {endpoint['bytes']} bytes, "
+          f"{endpoint['incompleteSlices']} incomplete slices, peak RSS {endpoint['peakRssMiB']} MiB")
+
+if __name__ == '__main__':
+    main()
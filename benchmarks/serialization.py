@@ -0,0 +1,88 @@
+"""
+Compares dict records serialised by Flask's default encoder with Records serialised
+through dumps_json() (orjson). Runs offline:
+
+    python benchmarks/serialization.py --records 50000
+
+Reports memory per record and serialisation time for dicts (as served from the
+snapshot store) and Records (as built by a fresh scan), and checks that every path
+produces JSON byte-identical to Flask's default encoder.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import awsbackend  # noqa: E402
+
+def build_items(count):
+    """Returns describe_instances-style items, with some non-ASCII tag values."""
+    return [{
+        'InstanceId': f'i-{index:017x}',
+        'InstanceType': ('t3.micro', 'm5.large', 'c6g.xlarge')[index % 3],
+        'State': {'Name': ('running', 'stopped')[index % 2]},
+        'Tags': [{'Key': 'Name', 'Value': f'web-{index}' if index % 50 else f'café-{index}'}],
+    } for index in range(count)]
+
+def measure(build):
+    """Returns (result, bytes allocated by build()) with tracemalloc."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    spec = awsbackend.SERVICE_SPECS['EC2']
+    items = build_items(args.records)
+    as_dicts = awsbackend.compile_projection([
+        ('id', 'InstanceId'), ('name', 'tag:Name', 'N/A'), ('type', 'InstanceType'), ('state', 'State.Name'),
+    ])
+
+    dicts, dict_bytes = measure(lambda: [as_dicts(item) for item in items])
+    records, record_bytes = measure(lambda: [spec.project(item) for item in items])
+    inventory_dicts = {'us-east-1': {'EC2': dicts}}
+    inventory_records = {'us-east-1': {'EC2': records}}
+
+    provider = awsbackend.app.json
+    # What jsonify() produced before: Flask's default provider over plain dicts.
+    baseline = lambda: json.dumps(inventory_dicts, default=provider.default, ensure_ascii=True,
+                                  sort_keys=True, separators=(',', ':'))
+    current = lambda: provider.dumps(inventory_records, separators=(',', ':'))
+    # Inventories served from the snapshot store are plain dicts decoded from SQLite.
+    stored = lambda: provider.dumps(inventory_dicts, separators=(',', ':'))
+    expected = baseline()
+    if current() != expected or stored() != expected:
+        sys.exit('Serialised output differs from the default encoder.')
+
+    baseline_seconds = best_of(args.repeat, baseline)
+    current_seconds = best_of(args.repeat, current)
+    stored_seconds = best_of(args.repeat, stored)
+    print(f"records: {args.records}  payload: {len(expected.encode())} bytes (identical)")
+    print(f"{'':18}{'bytes/record':>14}{'serialise (ms)':>16}")
+    print(f"{'dict + json':18}{dict_bytes / args.records:>14.1f}{baseline_seconds * 1000:>16.1f}")
+    print(f"{'dict + orjson':18}{dict_bytes / args.records:>14.1f}{stored_seconds * 1000:>16.1f}")
+    print(f"{'Record + orjson':18}{record_bytes / args.records:>14.1f}{current_seconds * 1000:>16.1f}")
+
+if __name__ == '__main__':
+    main()
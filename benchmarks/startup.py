@@ -0,0 +1,125 @@
+"""
+Cold-start benchmark: how long a fresh process takes to import awsbackend and answer
+its first GET /discover-aws, with startup preloading off and on:
+
+    python benchmarks/startup.py --runs 5 --regions 17 --latency-ms 30
+
+Every run is a new Python process, like a new Lambda execution environment. AWS is
+simulated offline as in benchmarks/discovery.py, so only latency configured here is
+spent waiting on the network. For each mode the median of the runs is reported:
+
+    import+init    start of the child script to the end of `import awsbackend`, with preloading
+    first request  the first /discover-aws, which pays for anything not built at init
+    cold total     import+init plus first request: what a cold invocation waits for
+    warm request   a second /discover-aws in the same process
+    process        wall time of the whole child process
+
+Pass --json to print the results as one JSON document for CI comparisons.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Commercial regions enabled in every account, us-east-1 first.
+REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1', 'eu-west-1', 'eu-west-2',
+    'eu-west-3', 'eu-central-1', 'eu-north-1', 'ap-south-1', 'ap-northeast-1', 'ap-northeast-2',
+    'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2', 'sa-east-1',
+]
+
+MEASUREMENTS = ('importSeconds', 'firstRequestSeconds', 'coldSeconds', 'warmRequestSeconds', 'processSeconds')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes per mode.')
+    parser.add_argument('--regions', type=int, default=len(REGIONS), help='Regions returned by describe_regions.')
+    parser.add_argument('--resources', type=int, default=20, help='Resources per service and region.')
+    parser.add_argument('--page-size', type=int, default=100, help='Items per simulated response page.')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Simulated latency of every call.')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON.')
+    parser.add_argument('--child', choices=('true', 'false'), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def run_child(args, started):
+    """Runs in the child process: imports the backend and serves two requests."""
+    import botocore.session
+    from discovery import SimulatedAWS
+
+    regions = REGIONS[:args.regions]
+    simulation = SimulatedAWS(regions, args.resources, args.resources, args.page_size, args.latency_ms / 1000,
+                              throttle_rate=0.0, seed=0, pagination_tokens=None)
+    # Preloading builds clients while awsbackend is imported, so the simulation has to be
+    # on every botocore Session from the start.
+    session_init = botocore.session.Session.__init__
+
+    def simulated_session_init(session, *init_args, **init_kwargs):
+        session_init(session, *init_args, **init_kwargs)
+        simulation.install(session)
+    botocore.session.Session.__init__ = simulated_session_init
+
+    import awsbackend
+    simulation.pagination_tokens = awsbackend.PAGINATION_TOKENS
+    imported = time.perf_counter()
+    client = awsbackend.app.test_client()
+    first = client.get('/discover-aws?refresh=true')
+    first_done = time.perf_counter()
+    warm = client.get('/discover-aws?refresh=true')
+    warm_done = time.perf_counter()
+    if first.status_code != 200 or warm.status_code != 200:
+        sys.exit(f'/discover-aws failed with {first.status_code}/{warm.status_code}: '
+                 f'{warm.get_data(as_text=True)[:500]}')
+    print(json.dumps({
+        'importSeconds': imported - started,
+        'firstRequestSeconds': first_done - imported,
+        'coldSeconds': first_done - started,
+        'warmRequestSeconds': warm_done - first_done,
+        'bytes': len(first.get_data()),
+    }))
+
+def run_mode(args, preload):
+    """Starts args.runs fresh processes with STARTUP_PRELOAD=preload and returns their medians."""
+    samples = {name: [] for name in MEASUREMENTS}
+    for _ in range(args.runs):
+        env = dict(os.environ, STARTUP_PRELOAD=preload, STARTUP_PRELOAD_REGIONS='all',
+                   AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+                   SNAPSHOT_DB_PATH=os.path.join(tempfile.mkdtemp(prefix='startup-benchmark-'), 'snapshots.sqlite3'))
+        command = [sys.executable, os.path.abspath(__file__), '--child', preload, '--regions', str(args.regions),
+                   '--resources', str(args.resources), '--page-size', str(args.page_size),
+                   '--latency-ms', str(args.latency_ms)]
+        started = time.perf_counter()
+        child = subprocess.run(command, env=env, capture_output=True, text=True)
+        elapsed = time.perf_counter() - started
+        if child.returncode != 0:
+            sys.exit(f'Benchmark process failed (STARTUP_PRELOAD={preload}):\n{child.stderr[-2000:]}')
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        result['processSeconds'] = elapsed
+        for name in MEASUREMENTS:
+            samples[name].append(result[name])
+    return {name: round(statistics.median(values), 3) for name, values in samples.items()}
+
+def main():
+    started = time.perf_counter()
+    args = parse_args()
+    if args.child is not None:
+        sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+        run_child(args, started)
+        return
+    results = {'config': vars(args), 'modes': {preload: run_mode(args, preload) for preload in ('false', 'true')}}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"runs={args.runs} regions={args.regions} resources={args.resources} latency={args.latency_ms}ms")
+    print(f"{'preload':<9}{'import+init':>13}{'first request':>15}{'cold total':>12}{'warm request':>14}{'process':>10}")
+    for preload, medians in results['modes'].items():
+        print(f"{preload:<9}{medians['importSeconds']:>13.3f}{medians['firstRequestSeconds']:>15.3f}"
+              f"{medians['coldSeconds']:>12.3f}{medians['warmRequestSeconds']:>14.3f}{medians['processSeconds']:>10.3f}")
+
+if __name__ == '__main__':
+    main()